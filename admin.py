@@ -0,0 +1,102 @@
+"""
+Operator-only endpoints, guarded by the MEMBRANE_ADMIN_TOKEN bearer token.
+"""
+import asyncio
+import hmac
+from functools import wraps
+
+from quart import current_app, jsonify, request
+
+import metrics
+from app_create import reload_config
+from profiling import (
+    InvalidProfileDurationError,
+    Profiler,
+    ProfilerBusyError,
+    ProfilingConfig,
+)
+
+
+def require_admin(func):
+    """
+    Reject requests without the configured admin bearer token.
+
+    Admin endpoints answer 404 when no admin token is configured, so they are
+    invisible unless explicitly enabled.
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        admin_token = current_app.config.get("MEMBRANE_ADMIN_TOKEN")
+        if not admin_token:
+            return jsonify({"error": "Not found"}), 404
+        scheme, _, provided = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            provided.encode(), admin_token.encode()
+        ):
+            return jsonify({"error": "Unauthorized"}), 401
+        return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def get_profiler(app) -> Profiler:
+    if "PROFILER" not in app.config:
+        app.config["PROFILER"] = Profiler(ProfilingConfig())
+    return app.config["PROFILER"]
+
+
+# pylint: disable=unused-variable
+def register_admin_routes(app):
+    """Admin routes"""
+
+    @app.route("/admin/metrics", methods=["GET"])
+    @require_admin
+    async def get_metrics():
+        """Report this worker's counters and gauges."""
+        return jsonify(metrics.snapshot()), 200
+
+    @app.route("/admin/reload", methods=["POST"])
+    @require_admin
+    async def reload():
+        """
+        Rebuild and swap in this worker's configuration.
+
+        Only the worker serving the request reloads; send SIGHUP to the serve.py
+        parent to reload every worker.
+        """
+        try:
+            snapshot = reload_config(app)
+        except Exception as error:
+            app.logger.exception("Configuration reload failed, keeping current one.")
+            return jsonify({"error": f"Configuration reload failed: {error}"}), 400
+        return jsonify({"version": snapshot.version}), 200
+
+    @app.route("/admin/profile/cpu", methods=["POST"])
+    @require_admin
+    async def profile_cpu():
+        """Sample the worker's threads for ?seconds=N and write collapsed stacks."""
+        seconds = request.args.get("seconds", type=float)
+        try:
+            result = await asyncio.to_thread(get_profiler(app).profile_cpu, seconds)
+        except InvalidProfileDurationError as error:
+            return jsonify({"error": str(error)}), 400
+        except ProfilerBusyError as error:
+            return jsonify({"error": str(error)}), 409
+        app.logger.info("CPU profile written to %s", result["path"])
+        return jsonify(result), 200
+
+    @app.route("/admin/profile/memory", methods=["POST"])
+    @require_admin
+    async def snapshot_memory():
+        """Dump a tracemalloc snapshot and report the top allocators since the last."""
+        result = await asyncio.to_thread(get_profiler(app).snapshot_memory)
+        app.logger.info("Memory snapshot written to %s", result["path"])
+        return jsonify(result), 200
+
+    @app.route("/admin/profile/memory", methods=["DELETE"])
+    @require_admin
+    async def stop_memory_tracing():
+        """Stop tracemalloc and drop the stored baseline snapshot."""
+        get_profiler(app).stop_memory_tracing()
+        return "", 204
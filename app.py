@@ -1,104 +1,230 @@
 """
 CFIA Membrane Backend Quart Application
 """
-import traceback
+import logging
+import math
 
-from quart import jsonify, request
+from quart import g, request, session
 
+import audit
+import metrics
+import tracing
+from admin import register_admin_routes
 from app_create import create_app
-from emails import EmailConfig, send_email
+from emails import (
+    EmailConfig,
+    EmailsException,
+    send_email,
+)
 from error_handlers import register_error_handlers
 from jwt_utils import (
+    CLIENT_TOKEN,
+    VERIFICATION_TOKEN,
+    VERIFIED_EMAIL_SESSION_KEY,
     JWTConfig,
     JWTError,
     decode_client_jwt_token,
     generate_email_verification_token,
     login_redirect_with_client_jwt,
+    precheck_token,
     redirect_to_client_app_using_verification_token,
+    token_kind,
 )
 from request_helpers import EmailError, validate_email_from_request
+from responses import json_response
 
 app = create_app()
 
 # Register custom error handlers for the Quart app
 register_error_handlers(app)
 
+# Register the operator-only admin routes
+register_admin_routes(app)
+
+
+@app.before_request
+async def start_request_span():
+    """Open the request span, continuing the caller's trace if one is given."""
+    g.request_span = tracing.start_span(
+        f"{request.method} {request.url_rule or request.path}",
+        parent=tracing.extract(request.headers.get(tracing.TRACEPARENT_HEADER)),
+        attributes={"http.method": request.method, "http.target": request.path},
+    )
+
+
+@app.after_request
+async def end_request_span(response):
+    """Close the request span and hand its trace context back to the caller."""
+    span = g.pop("request_span", None)
+    if span is not None:
+        span.set_attribute("http.status_code", response.status_code)
+        if span.recording:
+            response.headers[tracing.TRACEPARENT_HEADER] = span.traceparent
+        tracing.end_span(span)
+    return response
+
+
+@app.teardown_request
+async def close_request_span(error):
+    """Close the request span if the response was never finalized."""
+    span = g.pop("request_span", None)
+    if span is not None:
+        tracing.end_span(span, error)
+
 
 @app.before_request
 async def log_request_info():
     """Log incoming request headers and body for debugging purposes."""
+    # Reading the body is only worth it when it gets logged. DEBUG is the default
+    # MEMBRANE_LOGGING_LEVEL, so the read is only skipped at a higher level.
+    if not app.logger.isEnabledFor(logging.DEBUG):
+        return
     app.logger.debug("Headers: %s", request.headers)
     app.logger.debug("Body: %s", await request.get_data())
 
 
+async def send_verification_email(email, body, email_config, app_id, admission):
+    """Send the email the breaker admitted and audit whether it went out."""
+    try:
+        await send_email(email, body, email_config, app.logger, admission)
+    except EmailsException:
+        audit.record("verification_email", "failed", app_id=app_id, email=email)
+        raise
+    audit.record("verification_email", "sent", app_id=app_id, email=email)
+
+
 @app.route("/health", methods=["GET"])
 async def health():
     return app.config["MEMBRANE_HEALTH_MESSAGE"], 200
 
 
-@app.route("/authenticate", methods=["GET", "POST"])
+def checked_token_header(token, jwt_config: JWTConfig):
+    """Header of a well-formed token, or None once a malformed one is counted."""
+    header, rejection = precheck_token(token, jwt_config)
+    if rejection is not None:
+        metrics.increment("membrane_token_rejected_total", reason=rejection)
+        app.logger.info("Rejected malformed token: %s", rejection)
+    return header
+
+
+def invalid_token(error: JWTError, kind: str):
+    metrics.increment(
+        "membrane_token_invalid_total", kind=kind, error=type(error).__name__
+    )
+    # An expected client error, counted above: one line, no traceback.
+    app.logger.info("Invalid %s token: %s", kind, error)
+    return json_response(app.config["RESPONSE_BODIES"].invalid_request, 405)
+
+
+@app.route("/authenticate", methods=["GET"])
 async def authenticate():
     """
-    Authenticate the client request based on various possible inputs.
-
-    This endpoint can handle three types of requests:
-    1. If the request contains both a valid client JWT and an email:
-        - Validates the provided email.
-        - Generates a verification token and sends a verification email to the provided
-        address.
-    2. If the request only contains a valid client JWT without an email:
-        - Redirects the user to the Membrane frontend.
-    3. If client JWT decoding fails:
-        - Attempts to decode using the verification token method, to validate a user
-        attempting to confirm their email.
+    Follow the token passed in the ``token`` query parameter.
+
+    The token header tells which kind of token it is, so that each request runs a
+    single verification:
+    1. A verification token, from the link of a verification email:
+        - Redirects the user to the client application that requested it, and
+        remembers the verified email in the session.
+    2. A client JWT:
+        - Redirects the user to the Membrane frontend, or straight back to the
+        client application with a verification token if the session holds an
+        email verified earlier.
+
+    Email addresses are submitted with a POST, see ``submit_email``.
 
     Returns:
-        JSON response or redirect, depending on the provided inputs and their
-        validation.
+        A redirect, or an error response if the token is invalid.
     """
     app.logger.debug("Entering authenticate route")
     jwt_config: JWTConfig = app.config["JWT_CONFIG"]
-    email_config: EmailConfig = app.config["EMAIL_CONFIG"]
+    token = request.args.get("token")
 
-    try:
-        client_app_token = request.args.get("token")
-        client_app_decoded_token = decode_client_jwt_token(client_app_token, jwt_config)
+    # Turn away malformed tokens before any decoding or signature work.
+    header = checked_token_header(token, jwt_config)
+    if header is None:
+        return json_response(app.config["RESPONSE_BODIES"].invalid_request, 405)
 
-        if client_app_decoded_token and request.is_json:
-            email = validate_email_from_request(
-                (await request.get_json()).get("email"),
-                email_config.validation_pattern,
-            )
-            body = generate_email_verification_token(
-                email,
-                client_app_decoded_token[jwt_config.redirect_url_field],
-                jwt_config,
+    kind = token_kind(header)
+    try:
+        if kind == VERIFICATION_TOKEN:
+            return redirect_to_client_app_using_verification_token(
+                token, jwt_config, session=session
             )
+        return login_redirect_with_client_jwt(
+            app.config["MEMBRANE_FRONTEND"],
+            token,
+            jwt_config,
+            verified_email=session.get(VERIFIED_EMAIL_SESSION_KEY),
+        )
+    except JWTError as error:
+        # TODO: Redirect to membrane main site if token is invalid.
+        return invalid_token(error, kind)
+
+
+@app.route("/authenticate", methods=["POST"])
+async def submit_email():
+    """
+    Send a verification link to the email address posted with a client JWT.
 
-            app.add_background_task(send_email, email, body, email_config, app.logger)
-            return jsonify({"message": email_config.email_send_success}), 200
-        else:
-            return login_redirect_with_client_jwt(
-                app.config["MEMBRANE_FRONTEND"],
-                client_app_token,
-                jwt_config,
-            )
+    Validates the client JWT and the ``email`` of the JSON body, then generates a
+    verification token and emails its link to the address in the background.
 
-    except (JWTError, EmailError) as error:
-        app.logger.error("Error occurred: %s\n%s", error, traceback.format_exc())
-        try:
-            return redirect_to_client_app_using_verification_token(
-                client_app_token, jwt_config
-            )
-        except JWTError as inner_error:
-            app.logger.error(
-                "Secondary error encountered during redirect. Type of error: %s\n%s",
-                type(inner_error),
-                traceback.format_exc(),
-            )
-            # TODO: Redirect to membrane main site if token is invalid.
+    Returns:
+        JSON response, 200 once the email is queued, 503 while emails cannot be sent
+        and 405 for an invalid token or email address.
+    """
+    app.logger.debug("Entering submit_email route")
+    jwt_config: JWTConfig = app.config["JWT_CONFIG"]
+    email_config: EmailConfig = app.config["EMAIL_CONFIG"]
+    client_app_token = request.args.get("token")
+
+    header = checked_token_header(client_app_token, jwt_config)
+    if header is None or token_kind(header) != CLIENT_TOKEN:
+        return json_response(app.config["RESPONSE_BODIES"].invalid_request, 405)
 
-    return jsonify({"error": "Invalid request method"}), 405
+    try:
+        client_app_decoded_token = decode_client_jwt_token(client_app_token, jwt_config)
+    except JWTError as error:
+        return invalid_token(error, CLIENT_TOKEN)
+
+    app_id = client_app_decoded_token[jwt_config.app_id_field]
+    payload = await request.get_json(silent=True)
+    try:
+        email = validate_email_from_request(
+            payload.get("email") if isinstance(payload, dict) else None,
+            email_config.validation_regex,
+        )
+    except EmailError as error:
+        app.logger.info("Rejected email submission: %s", error)
+        audit.record("verification_requested", "invalid_email", app_id=app_id)
+        return json_response(app.config["RESPONSE_BODIES"].invalid_request, 405)
+
+    body = generate_email_verification_token(
+        email,
+        client_app_decoded_token[jwt_config.redirect_url_field],
+        jwt_config,
+        app_id=app_id,
+    )
+
+    # Tell the user now rather than accept a request whose email would fail or
+    # hang behind a degraded provider. The admission is taken here, so that a
+    # half-open breaker answers 200 to the probe's request only.
+    breaker = email_config.breaker
+    admission = breaker.allow_request()
+    if admission is None:
+        audit.record(
+            "verification_requested", "unavailable", app_id=app_id, email=email
+        )
+        response = json_response(app.config["RESPONSE_BODIES"].email_unavailable, 503)
+        response.headers["Retry-After"] = str(max(1, math.ceil(breaker.retry_after)))
+        return response
+
+    app.add_background_task(
+        send_verification_email, email, body, email_config, app_id, admission
+    )
+    audit.record("verification_requested", "accepted", app_id=app_id, email=email)
+    return json_response(app.config["RESPONSE_BODIES"].email_sent, 200)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,27 @@
+import asyncio
 import logging
 import os
+import signal
+from dataclasses import dataclass
 from datetime import timedelta
 from pathlib import Path
+from types import MappingProxyType
 
 from azure.communication.email import EmailClient
-from dotenv import load_dotenv
+from dotenv import dotenv_values
 from quart import Quart
-from quart_cors import cors
-from quart_session import Session
 
+import audit
+import circuit_breaker
+import cors
 import emails
 import jwt_utils
+import loop_monitor
+import metrics
+import profiling
+import responses
+import session_store
+import tracing
 from environment_validation import validate_environment_settings
 
 DEFAULT_MEMBRANE_LOGGING_LEVEL = "DEBUG"
@@ -20,16 +31,135 @@ DEFAULT_MEMBRANE_LOGGING_FORMAT = (
 DEFAULT_MEMBRANE_HEALTH_MESSAGE = "ok"
 DEFAULT_MEMBRANE_SESSION_LIFETIME_SECONDS = 300
 DEFAULT_MEMBRANE_SESSION_COOKIE_SECURE = "true"
-DEFAULT_MEMBRANE_SESSION_TYPE = "null"
+DEFAULT_MEMBRANE_SESSION_TYPE = "memory"
+DEFAULT_MEMBRANE_CORS_MAX_AGE_SECONDS = cors.DEFAULT_CORS_MAX_AGE_SECONDS
+DEFAULT_MEMBRANE_CORS_ALLOW_HEADERS = cors.DEFAULT_CORS_ALLOW_HEADERS
 DEFAULT_MEMBRANE_GENERIC_500_ERROR_FIELD = "error"
 DEFAULT_MEMBRANE_GENERIC_500_ERROR = (
     "An unexpected error occurred. Please try again later."
 )
 
 
-def create_app():
-    load_dotenv()
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    Immutable, versioned view of the reloadable configuration.
+
+    ``values`` holds the app.config entries built from the environment. A reload
+    builds a whole new snapshot and applies it in one synchronous step on the event
+    loop; requests already running keep the JWT and email configs they started with.
+    """
+
+    version: int
+    values: MappingProxyType
+
+
+def load_email_transport() -> emails.EmailTransport:
+    timeout = int(
+        os.getenv("MEMBRANE_EMAIL_SEND_TIMEOUT_SECONDS", emails.DEFAULT_TIMEOUT_SECONDS)
+    )
+    transport = os.getenv("MEMBRANE_EMAIL_TRANSPORT", emails.DEFAULT_EMAIL_TRANSPORT)
+    if transport == "azure":
+        return emails.AzureEmailTransport(
+            EmailClient.from_connection_string(
+                os.getenv("MEMBRANE_COMM_CONNECTION_STRING")
+            ),
+            poller_wait_seconds=int(
+                os.getenv(
+                    "MEMBRANE_EMAIL_SEND_POLLER_WAIT_TIME",
+                    emails.DEFAULT_POLLER_WAIT_SECONDS,
+                )
+            ),
+            timeout=timeout,
+        )
+    if transport == "smtp":
+        if not os.getenv("MEMBRANE_SMTP_HOST"):
+            raise ValueError("MEMBRANE_SMTP_HOST is required by the smtp transport.")
+        return emails.SMTPEmailTransport(
+            hostname=os.getenv("MEMBRANE_SMTP_HOST"),
+            port=int(os.getenv("MEMBRANE_SMTP_PORT", emails.DEFAULT_SMTP_PORT)),
+            username=os.getenv("MEMBRANE_SMTP_USERNAME"),
+            password=os.getenv("MEMBRANE_SMTP_PASSWORD"),
+            security=os.getenv("MEMBRANE_SMTP_SECURITY", emails.DEFAULT_SMTP_SECURITY),
+            pool_size=int(
+                os.getenv("MEMBRANE_SMTP_POOL_SIZE", emails.DEFAULT_SMTP_POOL_SIZE)
+            ),
+            max_messages_per_connection=int(
+                os.getenv(
+                    "MEMBRANE_SMTP_MAX_MESSAGES_PER_CONNECTION",
+                    emails.DEFAULT_SMTP_MAX_MESSAGES_PER_CONNECTION,
+                )
+            ),
+            timeout=timeout,
+        )
+    raise ValueError(
+        f"Invalid MEMBRANE_EMAIL_TRANSPORT {transport}, expected azure or smtp."
+    )
+
 
+def load_audit_config() -> audit.AuditConfig:
+    audit_file = os.getenv("MEMBRANE_AUDIT_FILE", audit.DEFAULT_AUDIT_FILE)
+    hash_key = os.getenv("MEMBRANE_AUDIT_HASH_KEY", os.getenv("MEMBRANE_SECRET_KEY"))
+    if audit_file and not hash_key:
+        raise ValueError(
+            "MEMBRANE_AUDIT_HASH_KEY or MEMBRANE_SECRET_KEY is required by the audit "
+            "trail; set MEMBRANE_AUDIT_FILE empty to disable it."
+        )
+    return audit.AuditConfig(
+        file_path=Path(audit_file) if audit_file else None,
+        hash_key=(hash_key or "").encode(),
+        max_bytes=int(
+            os.getenv("MEMBRANE_AUDIT_MAX_BYTES", audit.DEFAULT_AUDIT_MAX_BYTES)
+        ),
+        backup_count=int(
+            os.getenv("MEMBRANE_AUDIT_BACKUP_COUNT", audit.DEFAULT_AUDIT_BACKUP_COUNT)
+        ),
+        queue_size=int(
+            os.getenv("MEMBRANE_AUDIT_QUEUE_SIZE", audit.DEFAULT_AUDIT_QUEUE_SIZE)
+        ),
+    )
+
+
+def load_email_circuit_breaker() -> circuit_breaker.CircuitBreaker:
+    return circuit_breaker.CircuitBreaker(
+        "email",
+        circuit_breaker.CircuitBreakerConfig(
+            window_size=int(
+                os.getenv(
+                    "MEMBRANE_EMAIL_CIRCUIT_WINDOW_SIZE",
+                    circuit_breaker.DEFAULT_WINDOW_SIZE,
+                )
+            ),
+            minimum_calls=int(
+                os.getenv(
+                    "MEMBRANE_EMAIL_CIRCUIT_MINIMUM_CALLS",
+                    circuit_breaker.DEFAULT_MINIMUM_CALLS,
+                )
+            ),
+            failure_ratio=float(
+                os.getenv(
+                    "MEMBRANE_EMAIL_CIRCUIT_FAILURE_RATIO",
+                    circuit_breaker.DEFAULT_FAILURE_RATIO,
+                )
+            ),
+            slow_call_seconds=float(
+                os.getenv(
+                    "MEMBRANE_EMAIL_CIRCUIT_SLOW_CALL_SECONDS",
+                    circuit_breaker.DEFAULT_SLOW_CALL_SECONDS,
+                )
+            ),
+            open_seconds=float(
+                os.getenv(
+                    "MEMBRANE_EMAIL_CIRCUIT_OPEN_SECONDS",
+                    circuit_breaker.DEFAULT_OPEN_SECONDS,
+                )
+            ),
+        ),
+    )
+
+
+def load_config_snapshot(version: int) -> ConfigSnapshot:
+    """Build and validate a configuration snapshot from the environment."""
     jwt_config = jwt_utils.JWTConfig(
         client_public_keys_folder=Path(
             os.getenv(
@@ -69,27 +199,18 @@ def create_app():
                 "MEMBRANE_TOKEN_BLACKLIST", jwt_utils.DEFAULT_TOKEN_BLACKLIST
             ).split(",")
         ),
+        max_token_length=int(
+            os.getenv("MEMBRANE_MAX_TOKEN_LENGTH", jwt_utils.DEFAULT_MAX_TOKEN_LENGTH)
+        ),
     )
+
     email_config = emails.EmailConfig(
-        email_client=EmailClient.from_connection_string(
-            os.getenv("MEMBRANE_COMM_CONNECTION_STRING")
-        ),
+        transport=load_email_transport(),
         sender_email=os.getenv("MEMBRANE_SENDER_EMAIL"),
         subject=os.getenv("MEMBRANE_EMAIL_SUBJECT", emails.DEFAULT_EMAIL_SUBJECT),
         html_content=os.getenv(
             "MEMBRANE_EMAIL_SEND_HTML_TEMPLATE", emails.DEFAULT_HTML_CONTENT
         ),
-        poller_wait_seconds=int(
-            os.getenv(
-                "MEMBRANE_EMAIL_SEND_POLLER_WAIT_TIME",
-                emails.DEFAULT_POLLER_WAIT_SECONDS,
-            )
-        ),
-        timeout=int(
-            os.getenv(
-                "MEMBRANE_EMAIL_SEND_TIMEOUT_SECONDS", emails.DEFAULT_TIMEOUT_SECONDS
-            )
-        ),
         validation_pattern=os.getenv(
             "MEMBRANE_ALLOWED_EMAIL_DOMAINS_PATTERN",
             emails.DEFAULT_VALIDATION_PATTERN,
@@ -98,68 +219,308 @@ def create_app():
             "MEMBRANE_EMAIL_SEND_SUCCESS",
             emails.DEFAULT_SUCCESS_MESSAGE,
         ),
+        email_unavailable=os.getenv(
+            "MEMBRANE_EMAIL_UNAVAILABLE_MESSAGE",
+            emails.DEFAULT_UNAVAILABLE_MESSAGE,
+        ),
+        breaker=load_email_circuit_breaker(),
     )
 
-    app = Quart(__name__)
-
-    app.config.update(
-        {
-            "MEMBRANE_LOGGING_LEVEL": os.getenv(
-                "MEMBRANE_LOGGING_LEVEL", DEFAULT_MEMBRANE_LOGGING_LEVEL
+    generic_error_field = os.getenv(
+        "MEMBRANE_GENERIC_500_ERROR_FIELD", DEFAULT_MEMBRANE_GENERIC_500_ERROR_FIELD
+    )
+    generic_error = os.getenv(
+        "MEMBRANE_GENERIC_500_ERROR", DEFAULT_MEMBRANE_GENERIC_500_ERROR
+    )
+    cors_allowed_origins = os.getenv("MEMBRANE_CORS_ALLOWED_ORIGINS").split(",")
+    values = {
+        "MEMBRANE_LOGGING_LEVEL": os.getenv(
+            "MEMBRANE_LOGGING_LEVEL", DEFAULT_MEMBRANE_LOGGING_LEVEL
+        ),
+        "MEMBRANE_LOGGING_FORMAT": os.getenv(
+            "MEMBRANE_LOGGING_FORMAT", DEFAULT_MEMBRANE_LOGGING_FORMAT
+        ),
+        "MEMBRANE_HEALTH_MESSAGE": os.getenv(
+            "MEMBRANE_HEALTH_MESSAGE", DEFAULT_MEMBRANE_HEALTH_MESSAGE
+        ),
+        "PERMANENT_SESSION_LIFETIME": timedelta(
+            seconds=int(
+                os.getenv(
+                    "MEMBRANE_SESSION_LIFETIME_SECONDS",
+                    DEFAULT_MEMBRANE_SESSION_LIFETIME_SECONDS,
+                )
+            )
+        ),
+        "SESSION_COOKIE_SECURE": os.getenv(
+            "MEMBRANE_SESSION_COOKIE_SECURE", DEFAULT_MEMBRANE_SESSION_COOKIE_SECURE
+        ).lower()
+        == "true",
+        "SESSION_TYPE": os.getenv(
+            "MEMBRANE_SESSION_TYPE", DEFAULT_MEMBRANE_SESSION_TYPE
+        ),
+        "SESSION_MAX_ENTRIES": int(
+            os.getenv(
+                "MEMBRANE_SESSION_MAX_ENTRIES",
+                session_store.DEFAULT_SESSION_MAX_ENTRIES,
+            )
+        ),
+        "SESSION_SQLITE_FILE": os.getenv(
+            "MEMBRANE_SESSION_SQLITE_FILE", session_store.DEFAULT_SESSION_SQLITE_FILE
+        ),
+        "MEMBRANE_GENERIC_500_ERROR_FIELD": generic_error_field,
+        "MEMBRANE_GENERIC_500_ERROR": generic_error,
+        "JWT_CONFIG": jwt_config,
+        "EMAIL_CONFIG": email_config,
+        # The constant responses, serialized once rather than on every request.
+        "RESPONSE_BODIES": responses.build_response_bodies(
+            email_config.email_send_success,
+            email_config.email_unavailable,
+            generic_error_field,
+            generic_error,
+        ),
+        "MEMBRANE_CORS_ALLOWED_ORIGINS": cors_allowed_origins,
+        "CORS_POLICY": cors.compile_cors_policy(
+            cors_allowed_origins,
+            allow_credentials=True,
+            allow_headers=os.getenv(
+                "MEMBRANE_CORS_ALLOW_HEADERS", DEFAULT_MEMBRANE_CORS_ALLOW_HEADERS
             ),
-            "MEMBRANE_LOGGING_FORMAT": os.getenv(
-                "MEMBRANE_LOGGING_FORMAT", DEFAULT_MEMBRANE_LOGGING_FORMAT
+            max_age_seconds=int(
+                os.getenv(
+                    "MEMBRANE_CORS_MAX_AGE_SECONDS",
+                    DEFAULT_MEMBRANE_CORS_MAX_AGE_SECONDS,
+                )
             ),
-            "MEMBRANE_HEALTH_MESSAGE": os.getenv(
-                "MEMBRANE_HEALTH_MESSAGE", DEFAULT_MEMBRANE_HEALTH_MESSAGE
+        ),
+        "MEMBRANE_FRONTEND": os.getenv("MEMBRANE_FRONTEND"),
+        "SECRET_KEY": os.getenv("MEMBRANE_SECRET_KEY"),
+        "MEMBRANE_ADMIN_TOKEN": os.getenv("MEMBRANE_ADMIN_TOKEN"),
+    }
+
+    validate_environment_settings(
+        jwt_config.client_public_keys_folder,
+        jwt_config.server_private_key,
+        jwt_config.server_public_key,
+        values["MEMBRANE_FRONTEND"],
+    )
+    # Parse keys once, so that requests (and workers forked from this process) never
+    # pay for it.
+    jwt_config.keys = jwt_utils.load_key_registry(jwt_config)
+
+    return ConfigSnapshot(version, MappingProxyType(values))
+
+
+def apply_config_snapshot(app, snapshot: ConfigSnapshot):
+    """Swap ``snapshot`` in. Contains no await, so requests never see a mix."""
+    app.config.update(snapshot.values)
+    app.config["MEMBRANE_CONFIG_SNAPSHOT"] = snapshot
+    logging.getLogger().setLevel(
+        getattr(logging, snapshot.values["MEMBRANE_LOGGING_LEVEL"])
+    )
+
+
+# The variables set from ``.env`` rather than by the deployment's environment.
+_dotenv_keys = set()
+
+
+def load_dotenv_file():
+    """
+    Load ``.env`` into the environment, as a restart would.
+
+    Variables set by the deployment's environment take precedence over ``.env``.
+    Called again, the changes made to ``.env`` since are applied, and variables
+    that came from ``.env`` but were removed from it are unset.
+    """
+    values = {key: value for key, value in dotenv_values().items() if value is not None}
+    for key in _dotenv_keys - values.keys():
+        os.environ.pop(key, None)
+        _dotenv_keys.discard(key)
+    for key, value in values.items():
+        if key in os.environ and key not in _dotenv_keys:
+            continue
+        os.environ[key] = value
+        _dotenv_keys.add(key)
+
+
+def reload_config(app) -> ConfigSnapshot:
+    """
+    Rebuild the configuration from the environment and ``.env`` and swap it in.
+
+    The ledger of used verification tokens is carried over, and so is the state of
+    the email circuit breaker unless the email transport changed. If the new
+    configuration is invalid, the exception propagates and the current snapshot
+    stays in place.
+    """
+    load_dotenv_file()
+    current = app.config.get("MEMBRANE_CONFIG_SNAPSHOT")
+    snapshot = load_config_snapshot(current.version + 1 if current else 1)
+
+    if current is not None:
+        snapshot.values["JWT_CONFIG"].token_ledger = current.values[
+            "JWT_CONFIG"
+        ].token_ledger
+        new_email_config = snapshot.values["EMAIL_CONFIG"]
+        old_email_config = current.values["EMAIL_CONFIG"]
+        if type(new_email_config.transport) is type(old_email_config.transport):
+            # Keep the new thresholds, but not a fresh closed state for a provider
+            # that is still failing.
+            old_email_config.breaker.config = new_email_config.breaker.config
+            new_email_config.breaker = old_email_config.breaker
+
+    apply_config_snapshot(app, snapshot)
+    app.logger.info("Configuration version %d loaded.", snapshot.version)
+    if current is not None:
+        close_email_transport(current.values["EMAIL_CONFIG"].transport)
+    return snapshot
+
+
+_closing_transports = set()
+
+
+def close_email_transport(transport: emails.EmailTransport):
+    """Close a replaced transport; sends still using it go out unpooled."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Not serving (e.g. the serve.py parent), so no connection was opened.
+        return
+    task = loop.create_task(transport.close())
+    _closing_transports.add(task)
+    task.add_done_callback(_closing_transports.discard)
+
+
+def install_reload_signal_handler(app):
+    """Reload the configuration on SIGHUP. Must run on the serving event loop."""
+
+    def reload():
+        try:
+            reload_config(app)
+        except Exception:
+            app.logger.exception("Configuration reload failed, keeping current one.")
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload)
+    except (AttributeError, NotImplementedError):
+        app.logger.warning("SIGHUP reload is not supported on this platform.")
+
+
+def create_app():
+    load_dotenv_file()
+    snapshot = load_config_snapshot(1)
+
+    tracing.configure(
+        tracing.TracingConfig(
+            exporter=os.getenv(
+                "MEMBRANE_TRACING_EXPORTER", tracing.DEFAULT_TRACING_EXPORTER
             ),
-            "PERMANENT_SESSION_LIFETIME": timedelta(
-                seconds=int(
-                    os.getenv(
-                        "MEMBRANE_SESSION_LIFETIME_SECONDS",
-                        DEFAULT_MEMBRANE_SESSION_LIFETIME_SECONDS,
-                    )
+            sample_ratio=float(
+                os.getenv(
+                    "MEMBRANE_TRACING_SAMPLE_RATIO",
+                    tracing.DEFAULT_TRACING_SAMPLE_RATIO,
                 )
             ),
-            "SESSION_COOKIE_SECURE": os.getenv(
-                "MEMBRANE_SESSION_COOKIE_SECURE", DEFAULT_MEMBRANE_SESSION_COOKIE_SECURE
+            file_path=Path(
+                os.getenv("MEMBRANE_TRACING_FILE", tracing.DEFAULT_TRACING_FILE)
+            ),
+            otlp_endpoint=os.getenv(
+                "MEMBRANE_TRACING_OTLP_ENDPOINT", tracing.DEFAULT_TRACING_OTLP_ENDPOINT
+            ),
+            service_name=os.getenv(
+                "MEMBRANE_TRACING_SERVICE_NAME", tracing.DEFAULT_TRACING_SERVICE_NAME
+            ),
+            trust_traceparent=os.getenv(
+                "MEMBRANE_TRACING_TRUST_TRACEPARENT",
+                str(tracing.DEFAULT_TRACING_TRUST_TRACEPARENT),
             ).lower()
             == "true",
-            "SESSION_TYPE": os.getenv(
-                "MEMBRANE_SESSION_TYPE", DEFAULT_MEMBRANE_SESSION_TYPE
+        )
+    )
+
+    audit.configure(load_audit_config())
+
+    app = Quart(__name__)
+    app.json = responses.OrjsonProvider(app)
+    apply_config_snapshot(app, snapshot)
+    app.config["PROFILER"] = profiling.Profiler(
+        profiling.ProfilingConfig(
+            output_directory=Path(
+                os.getenv(
+                    "MEMBRANE_PROFILE_DIRECTORY", profiling.DEFAULT_PROFILE_DIRECTORY
+                )
             ),
-            "MEMBRANE_GENERIC_500_ERROR_FIELD": os.getenv(
-                "MEMBRANE_GENERIC_500_ERROR_FIELD",
-                DEFAULT_MEMBRANE_GENERIC_500_ERROR_FIELD,
+            default_seconds=float(
+                os.getenv("MEMBRANE_PROFILE_SECONDS", profiling.DEFAULT_PROFILE_SECONDS)
             ),
-            "MEMBRANE_GENERIC_500_ERROR": os.getenv(
-                "MEMBRANE_GENERIC_500_ERROR", DEFAULT_MEMBRANE_GENERIC_500_ERROR
+            max_seconds=float(
+                os.getenv(
+                    "MEMBRANE_PROFILE_MAX_SECONDS",
+                    profiling.DEFAULT_PROFILE_MAX_SECONDS,
+                )
             ),
-            "JWT_CONFIG": jwt_config,
-            "EMAIL_CONFIG": email_config,
-            "MEMBRANE_CORS_ALLOWED_ORIGINS": os.getenv(
-                "MEMBRANE_CORS_ALLOWED_ORIGINS"
-            ).split(","),
-            "MEMBRANE_FRONTEND": os.getenv("MEMBRANE_FRONTEND"),
-            "SECRET_KEY": os.getenv("MEMBRANE_SECRET_KEY"),
-        }
+        )
     )
 
-    validate_environment_settings(
-        jwt_config.client_public_keys_folder,
-        jwt_config.server_private_key,
-        jwt_config.server_public_key,
-        app.config["MEMBRANE_FRONTEND"],
+    loop_monitor_interval = float(
+        os.getenv(
+            "MEMBRANE_LOOP_MONITOR_INTERVAL_SECONDS",
+            loop_monitor.DEFAULT_LOOP_MONITOR_INTERVAL_SECONDS,
+        )
+    )
+    app.config["LOOP_MONITOR"] = (
+        loop_monitor.LoopMonitor(
+            loop_monitor.LoopMonitorConfig(
+                interval_seconds=loop_monitor_interval,
+                stall_threshold_seconds=float(
+                    os.getenv(
+                        "MEMBRANE_LOOP_STALL_THRESHOLD_SECONDS",
+                        loop_monitor.DEFAULT_LOOP_STALL_THRESHOLD_SECONDS,
+                    )
+                ),
+            ),
+            app.logger,
+        )
+        if loop_monitor_interval > 0
+        else None
     )
 
-    app = cors(
-        app,
-        allow_origin=app.config["MEMBRANE_CORS_ALLOWED_ORIGINS"],
-        allow_credentials=True,
+    metrics.register_gauge(
+        "membrane_circuit_state",
+        lambda: circuit_breaker.STATE_VALUES[app.config["EMAIL_CONFIG"].breaker.state],
+        circuit="email",
     )
+
+    cors.register_cors(app)
     logging.basicConfig(
         format=app.config["MEMBRANE_LOGGING_FORMAT"],
         level=getattr(logging, app.config["MEMBRANE_LOGGING_LEVEL"]),
     )
-    Session(app)
+    session_store.MembraneSession(app)
+
+    @app.before_serving
+    async def install_signal_handlers():
+        profiling.install_signal_handlers(app.config["PROFILER"], app.logger)
+        install_reload_signal_handler(app)
+
+    @app.before_serving
+    async def start_loop_monitor():
+        if app.config["LOOP_MONITOR"] is not None:
+            app.config["LOOP_MONITOR"].start()
+
+    @app.after_serving
+    async def stop_loop_monitor():
+        if app.config["LOOP_MONITOR"] is not None:
+            await app.config["LOOP_MONITOR"].stop()
+
+    @app.after_serving
+    async def flush_traces():
+        tracing.shutdown()
+
+    @app.after_serving
+    async def flush_audit_records():
+        await asyncio.to_thread(audit.shutdown)
+
+    @app.after_serving
+    async def close_email_connections():
+        await app.config["EMAIL_CONFIG"].transport.close()
+
     return app
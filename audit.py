@@ -0,0 +1,211 @@
+"""
+Audit trail of verification link requests and uses.
+
+Records are queued without blocking the request and written by a background
+thread to an append-only JSON lines file. Each batch is written with a single
+write and made durable with one fsync, and the file is rotated by size. When the
+queue is full, records are dropped and counted rather than slowing requests down.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+import metrics
+from batching import BatchWorker
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_AUDIT_FILE = "./audit.jsonl"
+DEFAULT_AUDIT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_AUDIT_BACKUP_COUNT = 10
+DEFAULT_AUDIT_QUEUE_SIZE = 10000
+DEFAULT_AUDIT_BATCH_SIZE = 512
+AUDIT_SHUTDOWN_TIMEOUT_SECONDS = 5
+
+
+@dataclass
+class AuditConfig:
+    file_path: Path
+    hash_key: bytes
+    max_bytes: int = DEFAULT_AUDIT_MAX_BYTES
+    backup_count: int = DEFAULT_AUDIT_BACKUP_COUNT
+    queue_size: int = DEFAULT_AUDIT_QUEUE_SIZE
+    batch_size: int = DEFAULT_AUDIT_BATCH_SIZE
+
+
+class RotatingJSONLWriter:
+    """
+    Append batches of JSON lines to ``path``, rotating it to ``path.1``..``path.N``.
+
+    Pre-forked workers share the file: a lock file serializes writes and rotation
+    across processes, and a writer whose file was rotated by another process
+    reopens the new one before writing. Without ``fcntl`` (on Windows) there is no
+    lock across processes, so only one worker should write to the file.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, backup_count: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = None
+        self._lock_file = None
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "ab")
+
+    def _rotated_elsewhere(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{index}")
+            if source.exists():
+                source.replace(self.path.with_name(f"{self.path.name}.{index + 1}"))
+        if self.backup_count > 0:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self._open()
+
+    def write(self, lines):
+        data = b"".join(lines)
+        if fcntl is not None and self._lock_file is None:
+            self._lock_file = open(self.path.with_name(f"{self.path.name}.lock"), "ab")
+        self._lock(True)
+        try:
+            if self._file is None or self._rotated_elsewhere():
+                self._open()
+            size = self._file.seek(0, os.SEEK_END)
+            if size and size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            self._lock(False)
+
+    def _lock(self, exclusive: bool):
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_UN)
+
+    def close(self):
+        for file in (self._file, self._lock_file):
+            if file is not None:
+                file.close()
+        self._file = self._lock_file = None
+
+
+class AuditLog:
+    """Queue audit records and write them in batches from a daemon thread."""
+
+    def __init__(self, config: AuditConfig, writer: RotatingJSONLWriter = None):
+        self.config = config
+        self.writer = writer or RotatingJSONLWriter(
+            config.file_path, config.max_bytes, config.backup_count
+        )
+        self.worker = BatchWorker(
+            self._write,
+            "membrane-audit-writer",
+            config.batch_size,
+            config.queue_size,
+            AUDIT_SHUTDOWN_TIMEOUT_SECONDS,
+        )
+
+    @property
+    def dropped(self) -> int:
+        return self.worker.dropped
+
+    @property
+    def backlog(self) -> int:
+        return self.worker.backlog
+
+    def hash_email(self, email: str) -> str:
+        """Keyed hash, so that the trail can be searched by email without storing it."""
+        return hmac.new(
+            self.config.hash_key, email.strip().lower().encode(), hashlib.sha256
+        ).hexdigest()
+
+    def record(self, event: str, outcome: str, app_id: str = None, email: str = None):
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "event": event,
+            "outcome": outcome,
+            "app_id": app_id,
+            "email_hash": self.hash_email(email) if email else None,
+        }
+        if not self.worker.submit(record):
+            metrics.increment("membrane_audit_dropped_total")
+            return False
+        return True
+
+    def _write(self, batch):
+        try:
+            self.writer.write([json.dumps(record).encode() + b"\n" for record in batch])
+        except OSError as error:
+            metrics.increment("membrane_audit_write_errors_total")
+            logging.error("Failed to write %d audit records: %s", len(batch), error)
+            return
+        metrics.increment("membrane_audit_written_total", len(batch))
+
+    def shutdown(self):
+        self.worker.shutdown()
+        self.writer.close()
+
+
+_audit_log: AuditLog = None
+
+
+def configure(config: AuditConfig, writer: RotatingJSONLWriter = None) -> AuditLog:
+    """Install the process-wide audit log; a config without file path disables it."""
+    global _audit_log
+    shutdown()
+    if config.file_path is not None:
+        _audit_log = AuditLog(config, writer)
+        metrics.register_gauge("membrane_audit_backlog", lambda: _audit_log.backlog)
+    return _audit_log
+
+
+def _restart_writer_after_fork():
+    # The writer thread does not survive fork(); give the child its own.
+    global _audit_log
+    if _audit_log is not None:
+        _audit_log = AuditLog(_audit_log.config)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_writer_after_fork)
+
+
+def get_audit_log() -> AuditLog:
+    return _audit_log
+
+
+def record(event: str, outcome: str, app_id: str = None, email: str = None):
+    """Queue an audit record; a no-op when auditing is not configured."""
+    if _audit_log is not None:
+        _audit_log.record(event, outcome, app_id=app_id, email=email)
+
+
+def shutdown():
+    """Write the queued records and stop the writer thread."""
+    global _audit_log
+    if _audit_log is not None:
+        _audit_log.shutdown()
+        metrics.unregister_gauge("membrane_audit_backlog")
+        _audit_log = None
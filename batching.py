@@ -0,0 +1,73 @@
+"""
+Background batching for work that should not hold up requests.
+
+``BatchWorker`` queues items without blocking the caller and hands them to a
+handler in batches from a daemon thread. Everything queued while the previous batch
+was being handled goes into the next one, so batches grow with the load. When the
+queue is full, items are dropped and counted rather than slowing the caller down.
+"""
+import queue
+import threading
+
+
+class BatchWorker:
+    """Queue items and pass them to ``handle`` in batches from a daemon thread."""
+
+    def __init__(
+        self,
+        handle,
+        name: str,
+        batch_size: int,
+        max_queue_size: int,
+        shutdown_timeout: float,
+    ):
+        self.handle = handle
+        self.batch_size = batch_size
+        self.shutdown_timeout = shutdown_timeout
+        self.queue = queue.Queue(max_queue_size)
+        self.dropped = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def backlog(self) -> int:
+        return self.queue.qsize()
+
+    def submit(self, item) -> bool:
+        """Queue ``item``; False when the queue is full and it was dropped."""
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _drain(self, block):
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get())
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return [item for item in batch if item is not None]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._drain(block=True)
+            if batch:
+                self.handle(batch)
+
+    def shutdown(self):
+        """Stop the thread, then handle what is still queued from the caller."""
+        self._stopped.set()
+        try:
+            # Wake the thread if it is waiting on an empty queue.
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(self.shutdown_timeout)
+        while batch := self._drain(block=False):
+            self.handle(batch)
@@ -0,0 +1,202 @@
+"""
+Load harness comparing serving profiles.
+
+For each profile, starts ``serve.py`` with MEMBRANE_SERVING_PROFILE set, keeps
+``--concurrency`` HTTP/1.1 keep-alive connections busy until ``--requests``
+requests have been answered, and reports throughput and latency percentiles.
+
+The server reads its configuration from the environment and ``.env`` as usual, so
+run this from a configured checkout:
+
+    python benchmarks/load_test.py --profiles default tuned --requests 20000
+
+Pass ``--url`` instead of ``--profiles`` to load a server that is already running.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_PATHS = ["/health", "/authenticate?token=not.a.token"]
+STARTUP_TIMEOUT_SECONDS = 30
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def read_response(reader: asyncio.StreamReader):
+    """Read one response; return its status and whether the connection stays open."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, *header_lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    await reader.readexactly(int(headers.get("content-length", 0)))
+    return int(status_line.split()[1]), headers.get("connection") != "close"
+
+
+async def run_connection(host, port, requests, counter, latencies, statuses):
+    reader = writer = None
+    try:
+        while counter[0] > 0:
+            counter[0] -= 1
+            request = requests[counter[0] % len(requests)]
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            started = time.perf_counter()
+            try:
+                writer.write(request)
+                status, keep_alive = await read_response(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                status, keep_alive = "error", False
+            else:
+                latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_load(url, paths, total_requests, concurrency):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    requests = [
+        f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n\r\n".encode()
+        for path in paths
+    ]
+    counter = [total_requests]
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            run_connection(host, port, requests, counter, latencies, statuses)
+            for _ in range(concurrency)
+        )
+    )
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(0.50) * 1000,
+        "p95_ms": percentile(0.95) * 1000,
+        "p99_ms": percentile(0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "statuses": statuses,
+    }
+
+
+def wait_until_ready(port, server):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"serve.py exited with code {server.returncode}.")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("serve.py did not start listening in time.")
+
+
+def run_profile(profile, arguments):
+    port = free_port()
+    environment = {
+        **os.environ,
+        "PORT": str(port),
+        "MEMBRANE_SERVING_PROFILE": profile,
+        "MEMBRANE_LOGGING_LEVEL": "WARNING",
+    }
+    if arguments.workers:
+        environment["MEMBRANE_WORKERS"] = arguments.workers
+    if arguments.event_loop:
+        environment["MEMBRANE_EVENT_LOOP"] = arguments.event_loop
+    server = subprocess.Popen(
+        [sys.executable, "serve.py"],
+        cwd=ROOT,
+        env=environment,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_ready(port, server)
+        url = f"http://127.0.0.1:{port}"
+        asyncio.run(
+            run_load(url, arguments.paths, arguments.warmup, arguments.concurrency)
+        )
+        return asyncio.run(
+            run_load(url, arguments.paths, arguments.requests, arguments.concurrency)
+        )
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=STARTUP_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def print_results(results):
+    print(
+        f"{'profile':<12}{'requests':>10}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}"
+        f"{'p99 ms':>9}{'max ms':>9}  statuses"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<12}{result['requests']:>10}{result['rps']:>10.0f}"
+            f"{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}"
+            f"{result['p99_ms']:>9.2f}{result['max_ms']:>9.2f}  {result['statuses']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--profiles", nargs="+", default=["default", "tuned"])
+    target.add_argument("--url", help="load a running server instead")
+    parser.add_argument("--paths", nargs="+", default=DEFAULT_PATHS)
+    parser.add_argument("--requests", type=int, default=10_000)
+    parser.add_argument("--warmup", type=int, default=1_000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--workers", help="override MEMBRANE_WORKERS")
+    parser.add_argument("--event-loop", help="override MEMBRANE_EVENT_LOOP")
+    arguments = parser.parse_args()
+
+    if arguments.url:
+        results = {
+            "running": asyncio.run(
+                run_load(
+                    arguments.url,
+                    arguments.paths,
+                    arguments.requests,
+                    arguments.concurrency,
+                )
+            )
+        }
+    else:
+        results = {
+            profile: run_profile(profile, arguments) for profile in arguments.profiles
+        }
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
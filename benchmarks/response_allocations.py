@@ -0,0 +1,128 @@
+"""
+Memory allocated and time spent per response on the JSON paths.
+
+Builds each response the way the routes used to, with ``jsonify`` and the default
+JSON provider, and the way they do now, from the bodies serialized once per
+configuration snapshot. Parsing a submitted email is compared between the default
+provider and ``OrjsonProvider``, and so is serializing a reply built per request.
+Needs no configuration:
+
+    python benchmarks/response_allocations.py --iterations 20000
+
+Allocations are measured with tracemalloc: the bytes allocated while building one
+response, counting those freed before it returns, averaged over the iterations.
+"""
+import argparse
+import asyncio
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from quart import Quart, jsonify
+from quart.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from responses import (  # noqa: E402
+    OrjsonProvider,
+    build_response_bodies,
+    json_response,
+)
+
+EMAIL_SEND_SUCCESS = "Valid email address. An email with a login link has been sent."
+GENERIC_ERROR_FIELD = "error"
+GENERIC_ERROR = "An unexpected error occurred. Please try again later."
+DYNAMIC_REPLY = {"counters": {"membrane_requests_total": 1024}, "gauges": {}}
+SUBMITTED_EMAIL = b'{"email":"someone@inspection.gc.ca"}'
+
+
+def allocated_bytes(build, iterations: int) -> float:
+    total = 0
+    tracemalloc.start()
+    try:
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            build()
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return total / iterations
+
+
+def seconds_per_call(build, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        build()
+    return (time.perf_counter() - started) / iterations
+
+
+def cases(app: Quart):
+    bodies = build_response_bodies(
+        EMAIL_SEND_SUCCESS, "", GENERIC_ERROR_FIELD, GENERIC_ERROR
+    )
+    default_provider = DefaultJSONProvider(app)
+    orjson_provider = OrjsonProvider(app)
+    return [
+        (
+            "email sent",
+            lambda: jsonify({"message": EMAIL_SEND_SUCCESS}),
+            lambda: json_response(bodies.email_sent, 200),
+        ),
+        (
+            "generic 500",
+            lambda: jsonify(
+                {app.config["GENERIC_ERROR_FIELD"]: app.config["GENERIC_ERROR"]}
+            ),
+            lambda: json_response(bodies.generic_error, 500),
+        ),
+        (
+            "invalid request",
+            lambda: jsonify({"error": "Invalid request method"}),
+            lambda: json_response(bodies.invalid_request, 405),
+        ),
+        (
+            "dynamic reply",
+            lambda: default_provider.response(DYNAMIC_REPLY),
+            lambda: orjson_provider.response(DYNAMIC_REPLY),
+        ),
+        (
+            "parse email",
+            lambda: default_provider.loads(SUBMITTED_EMAIL),
+            lambda: orjson_provider.loads(SUBMITTED_EMAIL),
+        ),
+    ]
+
+
+async def measure(iterations: int):
+    app = Quart(__name__)
+    app.config.update(
+        GENERIC_ERROR_FIELD=GENERIC_ERROR_FIELD, GENERIC_ERROR=GENERIC_ERROR
+    )
+    print(
+        f"{'path':<16} {'before B':>9} {'after B':>8} "
+        f"{'before us':>10} {'after us':>9}"
+    )
+    async with app.app_context():
+        for name, before, after in cases(app):
+            # Warm up caches and lazy imports before measuring.
+            before(), after()
+            print(
+                f"{name:<16} "
+                f"{allocated_bytes(before, iterations):>9.0f} "
+                f"{allocated_bytes(after, iterations):>8.0f} "
+                f"{seconds_per_call(before, iterations) * 1e6:>10.2f} "
+                f"{seconds_per_call(after, iterations) * 1e6:>9.2f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(measure(args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Circuit breaker for calls to an unreliable dependency.
+
+The breaker keeps the outcomes of the last calls. Calls that failed or took longer
+than ``slow_call_seconds`` count against the dependency. Once enough of them did,
+the breaker opens: callers fail immediately instead of queuing behind a degraded
+service. After ``open_seconds`` it lets a few probe calls through (half-open) and
+closes again if they succeed.
+
+Each admitted call carries the generation of the state it was admitted in, and its
+outcome is ignored once the breaker has changed state since: a call admitted while
+closed that ends after the breaker opened cannot decide a half-open breaker, only
+a probe can.
+"""
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+import metrics
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+# Value of the state gauge; higher is worse.
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+DEFAULT_WINDOW_SIZE = 20
+DEFAULT_MINIMUM_CALLS = 5
+DEFAULT_FAILURE_RATIO = 0.5
+DEFAULT_SLOW_CALL_SECONDS = 30
+DEFAULT_OPEN_SECONDS = 60
+DEFAULT_HALF_OPEN_PROBES = 1
+
+
+@dataclass(frozen=True)
+class Admission:
+    """A call let through by ``CircuitBreaker.allow_request``."""
+
+    generation: int
+
+
+@dataclass
+class CircuitBreakerConfig:
+    window_size: int = DEFAULT_WINDOW_SIZE
+    minimum_calls: int = DEFAULT_MINIMUM_CALLS
+    failure_ratio: float = DEFAULT_FAILURE_RATIO
+    slow_call_seconds: float = DEFAULT_SLOW_CALL_SECONDS
+    open_seconds: float = DEFAULT_OPEN_SECONDS
+    half_open_probes: int = DEFAULT_HALF_OPEN_PROBES
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        config: CircuitBreakerConfig = None,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.config = config or CircuitBreakerConfig()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._generation = 0
+
+    def _transition(self, state):
+        self._state = state
+        self._generation += 1
+        self._outcomes.clear()
+        self._probes = 0
+        if state == OPEN:
+            self._opened_at = self._clock()
+        metrics.increment(
+            "membrane_circuit_transitions_total", circuit=self.name, state=state
+        )
+
+    def _current_state(self):
+        if self._state == OPEN and self.retry_after == 0:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until an open breaker lets probe calls through."""
+        if self._state != OPEN:
+            return 0
+        return max(0, self._opened_at + self.config.open_seconds - self._clock())
+
+    def allow_request(self) -> Admission:
+        """
+        Admit a call, or return None when the breaker rejects it.
+
+        Every admission must be passed back to ``record`` with the call's outcome.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return Admission(self._generation)
+            if state == HALF_OPEN and self._probes < self.config.half_open_probes:
+                self._probes += 1
+                return Admission(self._generation)
+        metrics.increment("membrane_circuit_rejected_total", circuit=self.name)
+        return None
+
+    def record(self, admission: Admission, success: bool, duration: float):
+        """Record the outcome of an admitted call that took ``duration`` seconds."""
+        failed = not success or duration > self.config.slow_call_seconds
+        with self._lock:
+            if admission.generation != self._generation:
+                # Admitted before the last change of state, which it no longer
+                # has a say in.
+                return
+            if self._state == HALF_OPEN:
+                self._transition(OPEN if failed else CLOSED)
+                return
+            self._outcomes.append(failed)
+            while len(self._outcomes) > self.config.window_size:
+                self._outcomes.popleft()
+            if (
+                len(self._outcomes) >= self.config.minimum_calls
+                and sum(self._outcomes) / len(self._outcomes)
+                >= self.config.failure_ratio
+            ):
+                self._transition(OPEN)
@@ -0,0 +1,193 @@
+"""
+Cross-origin resource sharing (CORS) for the Membrane Backend.
+
+The allowed origins are compiled once per configuration snapshot into a set of
+exact origins plus wildcard-subdomain matchers, with the response header blocks
+prebuilt for each origin. The middleware runs in front of Quart: preflight requests
+are answered without creating a request context, and other responses get the
+prebuilt headers appended as they are sent.
+"""
+from dataclasses import dataclass, field
+
+DEFAULT_CORS_MAX_AGE_SECONDS = 600
+DEFAULT_CORS_ALLOW_HEADERS = "*"
+DEFAULT_CORS_ALLOW_METHODS = "GET, HEAD, POST, OPTIONS"
+MAX_CACHED_WILDCARD_ORIGINS = 1024
+
+VARY_ORIGIN = (b"vary", b"Origin")
+REJECTED_ORIGIN_HEADERS = (VARY_ORIGIN,)
+
+
+class CorsConfigError(ValueError):
+    """Raised when an allowed origin cannot be compiled."""
+
+
+@dataclass(frozen=True)
+class CorsPolicy:
+    exact_origins: frozenset = frozenset()
+    wildcard_origins: tuple = ()
+    allow_any_origin: bool = False
+    allow_credentials: bool = True
+    allow_methods: str = DEFAULT_CORS_ALLOW_METHODS
+    allow_headers: str = DEFAULT_CORS_ALLOW_HEADERS
+    max_age_seconds: int = DEFAULT_CORS_MAX_AGE_SECONDS
+    _header_blocks: dict = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+
+    def is_allowed(self, origin: bytes) -> bool:
+        if self.allow_any_origin or origin in self.exact_origins:
+            return True
+        for prefix, suffix in self.wildcard_origins:
+            if (
+                origin.startswith(prefix)
+                and origin.endswith(suffix)
+                and len(origin) > len(prefix) + len(suffix)
+                and b"/" not in origin[len(prefix) : -len(suffix)]
+            ):
+                return True
+        return False
+
+    def _build_header_blocks(self, origin: bytes):
+        if not self.is_allowed(origin):
+            return REJECTED_ORIGIN_HEADERS, REJECTED_ORIGIN_HEADERS
+        response_headers = [(b"access-control-allow-origin", origin), VARY_ORIGIN]
+        if self.allow_credentials:
+            response_headers.append((b"access-control-allow-credentials", b"true"))
+        preflight_headers = response_headers + [
+            (b"access-control-allow-methods", self.allow_methods.encode()),
+            (b"access-control-max-age", str(self.max_age_seconds).encode()),
+        ]
+        if self.allow_headers != "*":
+            preflight_headers.append(
+                (b"access-control-allow-headers", self.allow_headers.encode())
+            )
+        return tuple(response_headers), tuple(preflight_headers)
+
+    def header_blocks(self, origin: bytes):
+        """Return the (response, preflight) header blocks for ``origin``."""
+        blocks = self._header_blocks.get(origin)
+        if blocks is None:
+            if len(self._header_blocks) >= MAX_CACHED_WILDCARD_ORIGINS:
+                # Only wildcard and rejected origins get here; exact origins are
+                # prebuilt by compile_cors_policy and re-added on the next miss.
+                self._header_blocks.clear()
+            blocks = self._header_blocks[origin] = self._build_header_blocks(origin)
+        return blocks
+
+    def preflight_headers(self, origin: bytes, requested_headers: bytes = None):
+        headers = self.header_blocks(origin)[1]
+        if (
+            self.allow_headers == "*"
+            and requested_headers
+            and headers is not REJECTED_ORIGIN_HEADERS
+        ):
+            # "*" is not a wildcard for credentialed requests; echo what was asked.
+            headers = headers + ((b"access-control-allow-headers", requested_headers),)
+        return headers
+
+
+def compile_cors_policy(
+    allowed_origins,
+    allow_credentials: bool = True,
+    allow_methods: str = DEFAULT_CORS_ALLOW_METHODS,
+    allow_headers: str = DEFAULT_CORS_ALLOW_HEADERS,
+    max_age_seconds: int = DEFAULT_CORS_MAX_AGE_SECONDS,
+) -> CorsPolicy:
+    """
+    Compile allowed origins such as ``https://app.example.com``,
+    ``https://*.example.com`` or ``*`` into a CorsPolicy.
+    """
+    exact_origins = set()
+    wildcard_origins = []
+    allow_any_origin = False
+    for origin in (origin.strip().rstrip("/") for origin in allowed_origins):
+        if not origin:
+            continue
+        if origin == "*":
+            if allow_credentials:
+                # Any site could then make credentialed calls; quart-cors refused
+                # this combination too.
+                raise CorsConfigError(
+                    "Cannot allow credentials with the wildcard origin *."
+                )
+            allow_any_origin = True
+        elif "*" in origin:
+            prefix, _, suffix = origin.partition("*")
+            if (
+                "*" in suffix
+                or not prefix.endswith("://")
+                or not suffix.startswith(".")
+            ):
+                raise CorsConfigError(
+                    f"Invalid wildcard origin {origin}, expected scheme://*.domain."
+                )
+            wildcard_origins.append((prefix.encode(), suffix.encode()))
+        else:
+            exact_origins.add(origin.encode())
+
+    policy = CorsPolicy(
+        exact_origins=frozenset(exact_origins),
+        wildcard_origins=tuple(wildcard_origins),
+        allow_any_origin=allow_any_origin,
+        allow_credentials=allow_credentials,
+        allow_methods=allow_methods,
+        allow_headers=allow_headers,
+        max_age_seconds=max_age_seconds,
+    )
+    for origin in policy.exact_origins:
+        policy.header_blocks(origin)
+    return policy
+
+
+class CorsMiddleware:
+    """ASGI middleware applying the app's current ``CORS_POLICY``."""
+
+    def __init__(self, app, asgi_app):
+        self.app = app
+        self.asgi_app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        policy = self.app.config.get("CORS_POLICY")
+        if scope["type"] != "http" or policy is None:
+            return await self.asgi_app(scope, receive, send)
+
+        origin = requested_method = requested_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                requested_method = value
+            elif name == b"access-control-request-headers":
+                requested_headers = value
+        if origin is None:
+            return await self.asgi_app(scope, receive, send)
+
+        if scope["method"] == "OPTIONS" and requested_method is not None:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 204,
+                    "headers": policy.preflight_headers(origin, requested_headers),
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        cors_headers = policy.header_blocks(origin)[0]
+
+        async def send_with_cors_headers(message):
+            if message["type"] == "http.response.start":
+                message = {
+                    **message,
+                    "headers": [*message.get("headers", ()), *cors_headers],
+                }
+            await send(message)
+
+        await self.asgi_app(scope, receive, send_with_cors_headers)
+
+
+def register_cors(app):
+    """Wrap the app's ASGI callable with the CORS middleware."""
+    app.asgi_app = CorsMiddleware(app, app.asgi_app)
+    return app
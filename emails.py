@@ -1,8 +1,17 @@
-from dataclasses import dataclass
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from email.utils import make_msgid
 from logging import Logger
 
+import aiosmtplib
 from azure.communication.email import EmailClient
 
+import tracing
+from circuit_breaker import Admission, CircuitBreaker
+
 DEFAULT_HTML_CONTENT = "<html><h1>{}</h1></html>"
 DEFAULT_POLLER_WAIT_SECONDS = 10
 DEFAULT_TIMEOUT_SECONDS = 180
@@ -10,7 +19,16 @@ DEFAULT_VALIDATION_PATTERN = (
     "^[a-zA-Z0-9._+]+@(?:gc\.ca|canada\.ca|inspection\.gc\.ca)$"
 )
 DEFAULT_SUCCESS_MESSAGE = "Valid email address, Email sent with JWT link"
+DEFAULT_UNAVAILABLE_MESSAGE = (
+    "Emails cannot be sent at the moment, please try again later."
+)
 DEFAULT_EMAIL_SUBJECT = "Please Verify You Email Address"
+DEFAULT_EMAIL_TRANSPORT = "azure"
+DEFAULT_SMTP_PORT = 587
+DEFAULT_SMTP_SECURITY = "starttls"
+DEFAULT_SMTP_POOL_SIZE = 4
+DEFAULT_SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+SMTP_SECURITY_MODES = ("starttls", "tls", "none")
 
 
 class EmailsException(Exception):
@@ -29,50 +47,301 @@ class UnexpectedEmailSendError(EmailsException):
     """Custom Exception for unexpected errors."""
 
 
-@dataclass
-class EmailConfig:
-    email_client: EmailClient
-    sender_email: str
-    subject: str = DEFAULT_EMAIL_SUBJECT
-    validation_pattern: str = DEFAULT_VALIDATION_PATTERN
-    email_send_success: str = DEFAULT_SUCCESS_MESSAGE
-    html_content: str = DEFAULT_HTML_CONTENT
-    poller_wait_seconds: int = DEFAULT_POLLER_WAIT_SECONDS
-    timeout: int = DEFAULT_TIMEOUT_SECONDS
+class EmailProviderUnavailableError(EmailsException):
+    """Raised without sending while the email circuit breaker is open."""
+
+
+@dataclass(frozen=True)
+class OutgoingEmail:
+    sender: str
+    recipient: str
+    subject: str
+    plain_text: str
+    html: str
+
+
+class EmailTransport:
+    """
+    Delivers an OutgoingEmail.
 
+    ``send`` returns ``{"status": "Succeeded", "operation_id": ...}`` or raises an
+    EmailsException.
+    """
 
-def send_email(recipient_email, body: str, config: EmailConfig, logger: Logger) -> dict:
-    try:
-        message = {
-            "content": {
-                "subject": config.subject,
-                "plainText": body,
-                "html": config.html_content.format(body),
+    async def send(self, message: OutgoingEmail, logger: Logger) -> dict:
+        raise NotImplementedError
+
+    async def close(self):
+        """Release any connection held by the transport."""
+
+
+class AzureEmailTransport(EmailTransport):
+    """Azure Communication Services, polled until the send operation completes."""
+
+    def __init__(
+        self,
+        email_client: EmailClient,
+        poller_wait_seconds: int = DEFAULT_POLLER_WAIT_SECONDS,
+        timeout: int = DEFAULT_TIMEOUT_SECONDS,
+    ):
+        self.email_client = email_client
+        self.poller_wait_seconds = poller_wait_seconds
+        self.timeout = timeout
+
+    async def send(self, message: OutgoingEmail, logger: Logger) -> dict:
+        # The SDK client is synchronous; keep its network calls off the event loop.
+        poller = await asyncio.to_thread(
+            self.email_client.begin_send,
+            {
+                "content": {
+                    "subject": message.subject,
+                    "plainText": message.plain_text,
+                    "html": message.html,
+                },
+                "recipients": {"to": [{"address": message.recipient}]},
+                "senderAddress": message.sender,
             },
-            "recipients": {"to": [{"address": recipient_email}]},
-            "senderAddress": config.sender_email,
-        }
+        )
 
         time_elapsed = 0
-        poller = config.email_client.begin_send(message)
         while not poller.done():
-            logger.debug(f"Email send poller status: {poller.status()}")
-            poller.wait(config.poller_wait_seconds)
-            time_elapsed += config.poller_wait_seconds
+            with tracing.span("email.poll", elapsed_seconds=time_elapsed):
+                logger.debug(f"Email send poller status: {poller.status()}")
+                await asyncio.to_thread(poller.wait, self.poller_wait_seconds)
+            time_elapsed += self.poller_wait_seconds
 
-            if time_elapsed > config.timeout:
+            if time_elapsed > self.timeout:
                 raise PollingTimeoutError("Polling timed out.")
 
         result = poller.result()
-        if result["status"] == "Succeeded":
-            logger.info(f"Successfully sent the email (operation id: {result['id']})")
-            return {"status": "Succeeded", "operation_id": result["id"]}
-        else:
+        if result["status"] != "Succeeded":
             raise EmailSendingFailedError(result["error"], None)
+        return {"status": "Succeeded", "operation_id": result["id"]}
+
+
+class SMTPConnection:
+    def __init__(self, client: aiosmtplib.SMTP):
+        self.client = client
+        self.messages_sent = 0
+
+
+class SMTPEmailTransport(EmailTransport):
+    """
+    SMTP delivery over a pool of persistent, authenticated connections.
+
+    Each connection is opened (and authenticated) once and then carries up to
+    ``max_messages_per_connection`` messages back to back, so a send costs one
+    MAIL/RCPT/DATA exchange instead of a full session. At most ``pool_size``
+    messages are in flight at once; further sends wait for a free connection.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int = DEFAULT_SMTP_PORT,
+        username: str = None,
+        password: str = None,
+        security: str = DEFAULT_SMTP_SECURITY,
+        pool_size: int = DEFAULT_SMTP_POOL_SIZE,
+        max_messages_per_connection: int = DEFAULT_SMTP_MAX_MESSAGES_PER_CONNECTION,
+        timeout: int = DEFAULT_TIMEOUT_SECONDS,
+    ):
+        if security not in SMTP_SECURITY_MODES:
+            raise ValueError(
+                f"Invalid SMTP security mode {security}, expected one of "
+                f"{', '.join(SMTP_SECURITY_MODES)}."
+            )
+        if pool_size < 1 or max_messages_per_connection < 1:
+            raise ValueError(
+                "The SMTP pool size and messages per connection must be at least 1."
+            )
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.security = security
+        self.pool_size = pool_size
+        self.max_messages_per_connection = max_messages_per_connection
+        self.timeout = timeout
+        self.closed = False
+        self._loop = None
+        self._slots = None
+        self._idle = []
+
+    def _bind_to_running_loop(self):
+        # Connections and the semaphore belong to the loop that created them; a
+        # worker forked from the serving parent starts with a fresh pool.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.pool_size)
+            self._idle = []
+
+    async def _connect(self) -> SMTPConnection:
+        client = aiosmtplib.SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            username=self.username or None,
+            password=self.password or None,
+            use_tls=self.security == "tls",
+            start_tls=self.security == "starttls",
+            timeout=self.timeout,
+        )
+        await client.connect()
+        return SMTPConnection(client)
+
+    async def _disconnect(self, connection: SMTPConnection):
+        try:
+            await connection.client.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            connection.client.close()
+
+    async def _release(self, connection: SMTPConnection, reusable: bool):
+        if (
+            reusable
+            and not self.closed
+            and connection.client.is_connected
+            and connection.messages_sent < self.max_messages_per_connection
+        ):
+            self._idle.append(connection)
+        else:
+            await self._disconnect(connection)
+
+    async def _send_on(self, connection: SMTPConnection, email_message: EmailMessage):
+        await connection.client.send_message(email_message)
+        connection.messages_sent += 1
+
+    async def send(self, message: OutgoingEmail, logger: Logger) -> dict:
+        # Once closed, the pool stays empty and each send uses a one-off connection,
+        # so that requests still holding the replaced configuration get their email.
+        self._bind_to_running_loop()
+
+        email_message = EmailMessage()
+        email_message["From"] = message.sender
+        email_message["To"] = message.recipient
+        email_message["Subject"] = message.subject
+        email_message["Message-ID"] = make_msgid()
+        email_message.set_content(message.plain_text)
+        email_message.add_alternative(message.html, subtype="html")
+
+        async with self._slots:
+            reused = bool(self._idle)
+            connection = self._idle.pop() if reused else None
+            reusable = False
+            try:
+                if connection is None:
+                    connection = await self._connect()
+                try:
+                    await self._send_on(connection, email_message)
+                except aiosmtplib.SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    # The relay dropped the idle connection; retry on a fresh one.
+                    logger.debug("Pooled SMTP connection was closed, reconnecting.")
+                    connection.client.close()
+                    connection = await self._connect()
+                    await self._send_on(connection, email_message)
+                reusable = True
+            except (
+                aiosmtplib.SMTPResponseException,
+                aiosmtplib.SMTPRecipientsRefused,
+            ) as error:
+                # The relay answered and aiosmtplib reset the envelope, so the
+                # session can carry the next message.
+                reusable = True
+                raise EmailSendingFailedError(
+                    f"SMTP server refused the message: {error}"
+                ) from error
+            except aiosmtplib.SMTPException as error:
+                raise EmailSendingFailedError(
+                    f"SMTP delivery failed: {error}"
+                ) from error
+            finally:
+                if connection is not None:
+                    await self._release(connection, reusable)
+
+        return {"status": "Succeeded", "operation_id": email_message["Message-ID"]}
+
+    async def close(self):
+        """
+        Quit the idle connections and stop pooling; connections in use are closed on
+        release. Later sends still go out, each on a connection of its own.
+        """
+        self.closed = True
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(self._disconnect(connection) for connection in idle))
+
+
+@dataclass
+class EmailConfig:
+    transport: EmailTransport
+    sender_email: str
+    subject: str = DEFAULT_EMAIL_SUBJECT
+    validation_pattern: str = DEFAULT_VALIDATION_PATTERN
+    email_send_success: str = DEFAULT_SUCCESS_MESSAGE
+    html_content: str = DEFAULT_HTML_CONTENT
+    email_unavailable: str = DEFAULT_UNAVAILABLE_MESSAGE
+    breaker: CircuitBreaker = field(default_factory=lambda: CircuitBreaker("email"))
+    validation_regex: re.Pattern = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Compiled once here, so that requests (and workers forked from the process
+        # that loaded the configuration) never pay for it.
+        self.validation_regex = re.compile(self.validation_pattern)
+
+
+async def send_email(
+    recipient_email,
+    body: str,
+    config: EmailConfig,
+    logger: Logger,
+    admission: Admission = None,
+) -> dict:
+    """
+    Send ``body`` to ``recipient_email`` through the circuit breaker.
+
+    A caller that already asked the breaker passes its ``admission`` on, otherwise
+    the send asks for one itself.
+    """
+    with tracing.span(
+        "email.send",
+        sender=config.sender_email,
+        transport=type(config.transport).__name__,
+    ) as span:
+        if admission is None:
+            admission = config.breaker.allow_request()
+        if admission is None:
+            span.set_attribute("email.status", "CircuitOpen")
+            raise EmailProviderUnavailableError(
+                "The email circuit breaker is open, the email was not sent."
+            )
+        started = time.monotonic()
+        succeeded = False
+        try:
+            message = OutgoingEmail(
+                sender=config.sender_email,
+                recipient=recipient_email,
+                subject=config.subject,
+                plain_text=body,
+                html=config.html_content.format(body),
+            )
+            result = await config.transport.send(message, logger)
+            span.set_attribute("email.operation_id", str(result["operation_id"]))
+            span.set_attribute("email.status", result["status"])
+            logger.info(
+                f"Successfully sent the email (operation id: {result['operation_id']}, "
+                f"trace id: {span.trace_id})"
+            )
+            succeeded = True
+            return result
 
-    except EmailsException as e:
-        logger.exception(e)
-        raise
-    except Exception as e:
-        logger.exception(e)
-        raise UnexpectedEmailSendError(f"An unexpected error occurred: {e}") from e
+        except EmailsException as e:
+            logger.exception(e)
+            raise
+        except Exception as e:
+            logger.exception(e)
+            raise UnexpectedEmailSendError(f"An unexpected error occurred: {e}") from e
+        finally:
+            # Also reached on cancellation, which then counts as a failure and frees
+            # the half-open probe slot.
+            config.breaker.record(admission, succeeded, time.monotonic() - started)
@@ -19,6 +19,12 @@ def validate_environment_settings(
     - ValueError: If any of the provided settings are invalid.
     """
 
+    # Check the client public keys directory
+    if not CLIENT_PUBLIC_KEYS_DIRECTORY.is_dir():
+        raise ValueError(
+            f"The specified client public keys directory {CLIENT_PUBLIC_KEYS_DIRECTORY} "
+            "does not exist or is not a directory.")
+
     # Check the server private key
     if not SERVER_PRIVATE_KEY.exists():
         raise ValueError(
@@ -1,4 +1,4 @@
-from quart import jsonify
+from responses import json_response
 
 
 # pylint: disable=unused-variable
@@ -9,6 +9,4 @@ def register_error_handlers(app):
     def handle_generic_error(error):
         """Handle all unexpected errors."""
         app.logger.exception(f"Unexpected error occurred: {error}")
-        generic_error_field = app.config["MEMBRANE_GENERIC_500_ERROR_FIELD"]
-        generic_error = app.config["MEMBRANE_GENERIC_500_ERROR"]
-        return jsonify({generic_error_field: generic_error}), 500
+        return json_response(app.config["RESPONSE_BODIES"].generic_error, 500)
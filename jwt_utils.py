@@ -1,16 +1,27 @@
 """
 Utilities for encoding, decoding, and validating JWT tokens.
 """
+
+import base64
+import heapq
+import json
 import logging
-from copy import copy
+import re
+import threading
+import time
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
 
 from jwt import decode, encode
 from jwt import exceptions as jwt_exceptions
+from jwt.algorithms import get_default_algorithms
 from quart import redirect, url_for
 
+import audit
+import metrics
+import tracing
+
 DEFAULT_CLIENT_PUBLIC_KEYS_DIRECTORY = "./keys/client"
 DEFAULT_SERVER_PUBLIC_KEY = "./keys/server_public.pem"
 DEFAULT_SERVER_PRIVATE_KEY = "./keys/server_private.pem"
@@ -21,6 +32,33 @@ DEFAULT_DATA_FIELD = "data"
 DEFAULT_JWT_ACCESS_TOKEN_EXPIRE_SECONDS = 300
 DEFAULT_JWT_EXPIRE_SECONDS = 300
 DEFAULT_TOKEN_BLACKLIST = ""
+DEFAULT_MAX_TOKEN_LENGTH = 4096
+# Far above the few fields of a real header, low enough that json.loads cannot
+# recurse deeply on it.
+MAX_TOKEN_HEADER_LENGTH = 1024
+TOKEN_LEDGER_EXPIRY_GRACE_SECONDS = 60
+VERIFICATION_APP_ID_CLAIM = "azp"
+VERIFIED_EMAIL_SESSION_KEY = "verified_email"
+# Verification tokens name this server as issuer, and their header names its key,
+# so that they are told apart from client tokens without decoding them.
+VERIFICATION_TOKEN_ISSUER = "membrane"
+VERIFICATION_TOKEN_KEY_ID = "membrane-verification"
+CLIENT_PUBLIC_KEY_SUFFIX = "_public_key.pem"
+
+# Reason codes reported by precheck_token.
+TOKEN_MISSING = "missing"
+TOKEN_TOO_LONG = "too_long"
+TOKEN_BAD_SEGMENT_COUNT = "bad_segment_count"
+TOKEN_BAD_ALPHABET = "bad_alphabet"
+TOKEN_BAD_HEADER = "bad_header"
+TOKEN_BAD_ALGORITHM = "bad_algorithm"
+TOKEN_BAD_TYPE = "bad_type"
+
+# Kinds of token returned by token_kind.
+CLIENT_TOKEN = "client"
+VERIFICATION_TOKEN = "verification"
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+")
 
 
 class JWTError(Exception):
@@ -39,10 +77,6 @@ class JWTPrivateKeyNotFoundError(JWTError):
     """Raised when the private key is not found."""
 
 
-class BlacklistedTokenError(JWTError):
-    """Raised when the provided token is blacklisted."""
-
-
 class InvalidTokenError(JWTError):
     """Raised when the provided token is invalid."""
 
@@ -59,6 +93,48 @@ class JWTExpired(JWTError):
     """Raised when the provided token is expired."""
 
 
+@dataclass(frozen=True)
+class KeyRegistry:
+    """Keys parsed once from the configured PEM files, keyed by client app id."""
+
+    client_public_keys: dict
+    server_public_key: object
+    server_private_key: object
+
+
+class TokenLedger:
+    """
+    Verification tokens already used by this process.
+
+    Each token is forgotten once it has expired (plus a grace period), since its
+    ``exp`` claim rejects it from then on. The ledger is carried over configuration
+    reloads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._used = set()
+        self._expiries = []
+
+    def consume(self, token: str, expires_at: float) -> bool:
+        """Mark ``token`` used; return True if it had not been used before."""
+        horizon = time.time() - TOKEN_LEDGER_EXPIRY_GRACE_SECONDS
+        with self._lock:
+            while self._expiries and self._expiries[0][0] < horizon:
+                self._used.discard(heapq.heappop(self._expiries)[1])
+            if token in self._used:
+                return False
+            self._used.add(token)
+            heapq.heappush(self._expiries, (expires_at, token))
+            return True
+
+    def __contains__(self, token) -> bool:
+        return token in self._used
+
+    def __len__(self) -> int:
+        return len(self._used)
+
+
 @dataclass
 class JWTConfig:
     client_public_keys_folder: Path
@@ -71,9 +147,113 @@ class JWTConfig:
     jwt_access_token_expire_seconds: int = DEFAULT_JWT_ACCESS_TOKEN_EXPIRE_SECONDS
     jwt_expire_seconds: int = DEFAULT_JWT_EXPIRE_SECONDS
     token_blacklist: set = field(default_factory=set)
+    token_ledger: TokenLedger = field(default_factory=TokenLedger)
     token_type: str = "JWT"
+    max_token_length: int = DEFAULT_MAX_TOKEN_LENGTH
+    keys: KeyRegistry = None
+
+
+def load_key_registry(config: JWTConfig) -> KeyRegistry:
+    """
+    Read and parse every configured key.
+
+    Parsing PEM files is the most expensive part of a signature check; doing it once
+    at startup keeps it off the request path and lets pre-forked workers share the
+    parsed keys.
+    """
+    algorithm = get_default_algorithms()[config.algorithm]
+    client_public_keys = {
+        path.name[: -len(CLIENT_PUBLIC_KEY_SUFFIX)]: algorithm.prepare_key(
+            path.read_text()
+        )
+        for path in sorted(config.client_public_keys_folder.iterdir())
+        if path.name.endswith(CLIENT_PUBLIC_KEY_SUFFIX) and path.is_file()
+    }
+    return KeyRegistry(
+        client_public_keys=client_public_keys,
+        server_public_key=algorithm.prepare_key(config.server_public_key.read_text()),
+        server_private_key=algorithm.prepare_key(config.server_private_key.read_text()),
+    )
+
+
+def get_client_public_key(app_id, config: JWTConfig):
+    if config.keys is not None:
+        return config.keys.client_public_keys.get(app_id)
+    public_key_path = (
+        config.client_public_keys_folder / f"{app_id}{CLIENT_PUBLIC_KEY_SUFFIX}"
+    )
+    if not public_key_path.exists():
+        return None
+    with public_key_path.open("r") as key_file:
+        return key_file.read()
+
+
+def get_server_public_key(config: JWTConfig):
+    if config.keys is not None:
+        return config.keys.server_public_key
+    with config.server_public_key.open("r") as key_file:
+        return key_file.read()
+
+
+def get_server_private_key(config: JWTConfig):
+    if config.keys is not None:
+        return config.keys.server_private_key
+    if not config.server_private_key.exists():
+        raise JWTPrivateKeyNotFoundError("Private key not found")
+    with config.server_private_key.open("r") as key_file:
+        return key_file.read()
+
 
+def precheck_token(jwt_token, config: JWTConfig):
+    """
+    Structurally check a token before any signature work.
 
+    Checks the length, the three base64url segments and the header's ``alg`` and
+    ``typ``, without raising. Returns ``(header, None)`` for a well-formed token, or
+    ``(None, reason)`` with one of the ``TOKEN_*`` reason codes.
+    """
+    if not jwt_token:
+        return None, TOKEN_MISSING
+    if len(jwt_token) > config.max_token_length:
+        return None, TOKEN_TOO_LONG
+    if jwt_token.count(".") != 2:
+        return None, TOKEN_BAD_SEGMENT_COUNT
+    if TOKEN_PATTERN.fullmatch(jwt_token) is None:
+        return None, TOKEN_BAD_ALPHABET
+
+    encoded_header = jwt_token[: jwt_token.index(".")]
+    if len(encoded_header) > MAX_TOKEN_HEADER_LENGTH:
+        return None, TOKEN_BAD_HEADER
+    try:
+        decoded_header = base64.urlsafe_b64decode(
+            encoded_header + "=" * (-len(encoded_header) % 4)
+        )
+        if not decoded_header.lstrip().startswith(b"{"):
+            return None, TOKEN_BAD_HEADER
+        header = json.loads(decoded_header)
+    except (ValueError, RecursionError):
+        return None, TOKEN_BAD_HEADER
+    if not isinstance(header, dict):
+        return None, TOKEN_BAD_HEADER
+    if header.get("alg") != config.algorithm:
+        return None, TOKEN_BAD_ALGORITHM
+    token_type = header.get("typ")
+    if token_type is not None and (
+        not isinstance(token_type, str)
+        or token_type.upper() != config.token_type.upper()
+    ):
+        return None, TOKEN_BAD_TYPE
+    return header, None
+
+
+def token_kind(header: dict) -> str:
+    """Tell a verification token issued by this server from a client app token."""
+    if header.get("kid") == VERIFICATION_TOKEN_KEY_ID:
+        return VERIFICATION_TOKEN
+    return CLIENT_TOKEN
+
+
+@tracing.traced("jwt.decode_client_token")
 def decode_client_jwt_token(jwt_token, config: JWTConfig):
     if not jwt_token:
         raise JWTError("No JWT token provided in query parameters.")
@@ -87,25 +267,24 @@ def decode_client_jwt_token(jwt_token, config: JWTConfig):
 
         app_id = unverified_decoded_token[config.app_id_field]
 
-        # Look for a corresponding public key file
-        public_key_path = config.client_public_keys_folder / f"{app_id}_public_key.pem"
+        with tracing.span("jwt.client_key_lookup", app_id=app_id):
+            public_key = get_client_public_key(app_id, config)
 
-        if not public_key_path.exists():
+        if public_key is None:
             raise JWTPublicKeyNotFoundError(
                 f"Public key not found for app_id: {app_id} {unverified_decoded_token}."
             )
 
-        with public_key_path.open("r") as key_file:
-            public_key = key_file.read()
-
         # Decode the token using the fetched public key
         decoded_token = decode(jwt_token, public_key, algorithms=[config.algorithm])
         # Retrieve the redirect URL.
-        redirect_url = decoded_token[config.redirect_url_field]
+        redirect_url = decoded_token.get(config.redirect_url_field)
         if not redirect_url:
             raise JWTError("No redirect URL found in Token.")
 
-        expired_time = decoded_token["exp"]
+        expired_time = decoded_token.get("exp")
+        if expired_time is None:
+            raise JWTError("No expiration time found in Token.")
 
         # Get current time
         current_time = datetime.utcnow()
@@ -122,41 +301,42 @@ def decode_client_jwt_token(jwt_token, config: JWTConfig):
 
 
 def login_redirect_with_client_jwt(
-    membrane_frontend: str, client_app_token: str, config: JWTConfig
+    membrane_frontend: str,
+    client_app_token: str,
+    config: JWTConfig,
+    verified_email: str = None,
 ):
+    """
+    Send a client app's user on to the Membrane frontend to enter their email.
+
+    A user whose ``verified_email`` is known from their session is instead sent
+    straight back to the client app with a verification token, without another
+    email round trip.
+    """
+    decoded_token = decode_client_jwt_token(client_app_token, config)
+    if verified_email is None:
+        return redirect(f"{membrane_frontend}?token={client_app_token}")
+    redirect_url = decoded_token[config.redirect_url_field]
+    app_id = decoded_token[config.app_id_field]
+    verification_token = issue_email_verification_token(
+        verified_email, redirect_url, config, app_id=app_id
+    )
+    metrics.increment("membrane_session_redirects_total")
+    audit.record("session_redirect", "verified", app_id=app_id, email=verified_email)
+    return redirect(f"{redirect_url}?token={verification_token}", code=302)
+
+
+@tracing.traced("jwt.verify_email_verification_token")
+def verify_email_verification_token(jwt_token: str, config: JWTConfig):
+    """Check a verification token's signature and claims, whether used or not."""
+    public_key = get_server_public_key(config)
     try:
-        decode_client_jwt_token(client_app_token, config)
-        redirect_url_with_token = f"{membrane_frontend}?token={client_app_token}"
-        return redirect(redirect_url_with_token)
-    except Exception as error:
-        logging.error("Failed to decode client application token: %s", error)
-        raise InvalidClientTokenError(
-            "Failed to decode client application token."
-        ) from error
-
-
-def process_email_verification_token(email_token: str, config: JWTConfig):
-    try:
-        decoded_email_token = decode_email_verification_token(email_token, config)
-        config.token_blacklist.add(email_token)
-        email_token_redirect = (
-            f"{decoded_email_token[config.redirect_url_field]}?token={email_token}"
+        decoded_token = decode(
+            jwt_token,
+            public_key,
+            algorithms=[config.algorithm],
+            issuer=VERIFICATION_TOKEN_ISSUER,
         )
-        return redirect(email_token_redirect, code=302)
-    except JWTError as error:
-        logging.error(f"Failed to verify and decode email token: {error}")
-        raise
-
-
-def decode_email_verification_token(jwt_token: str, config: JWTConfig):
-    if not jwt_token:
-        raise JWTError("No JWT token provided in query parameters.")
-    if jwt_token in config.token_blacklist:
-        raise BlacklistedTokenError("This token has been blacklisted.")
-    with config.server_public_key.open("r") as key_file:
-        public_key = key_file.read()
-    try:
-        decoded_token = decode(jwt_token, public_key, algorithms=[config.algorithm])
         if config.redirect_url_field not in decoded_token:
             raise JWTError("No redirect URL found in token.")
         expired_time = decoded_token["exp"]
@@ -168,51 +348,86 @@ def decode_email_verification_token(jwt_token: str, config: JWTConfig):
         raise InvalidTokenError(str(error)) from error
 
 
-def generate_email_verification_token(email: str, redirect_url: str, config: JWTConfig):
+def consume_email_verification_token(jwt_token: str, config: JWTConfig):
+    """
+    Verify a verification token once, then mark it used.
+
+    Returns the decoded token and whether this was its first use. Tokens listed in
+    the configured blacklist count as already used.
+    """
+    if not jwt_token:
+        raise JWTError("No JWT token provided in query parameters.")
+    decoded_token = verify_email_verification_token(jwt_token, config)
+    fresh = jwt_token not in config.token_blacklist and config.token_ledger.consume(
+        jwt_token, decoded_token["exp"]
+    )
+    return decoded_token, fresh
+
+
+def issue_email_verification_token(
+    email: str, redirect_url: str, config: JWTConfig, app_id: str = None
+) -> str:
     expiration_time = datetime.utcnow() + timedelta(seconds=config.jwt_expire_seconds)
     expiration_timestamp = int(expiration_time.timestamp())
     payload = {
+        "iss": VERIFICATION_TOKEN_ISSUER,
         "sub": email,
         "exp": expiration_timestamp,
         config.redirect_url_field: redirect_url,
     }
-    email_token = encode_email_verification_token(payload, config)
+    if app_id is not None:
+        # "azp" (authorized party) rather than the client app id field, so that the
+        # token is never mistaken for a client app token.
+        payload[VERIFICATION_APP_ID_CLAIM] = app_id
+    return encode_email_verification_token(payload, config)
+
+
+def generate_email_verification_token(
+    email: str, redirect_url: str, config: JWTConfig, app_id: str = None
+):
+    email_token = issue_email_verification_token(email, redirect_url, config, app_id)
     verification_url = url_for("authenticate", token=email_token, _external=True)
     return verification_url
 
 
+@tracing.traced("jwt.encode_email_verification_token")
 def encode_email_verification_token(payload: dict, config: JWTConfig):
-    if not config.server_private_key.exists():
-        raise JWTPrivateKeyNotFoundError("Private key not found")
-    with config.server_private_key.open("r") as key_file:
-        private_key = key_file.read()
+    private_key = get_server_private_key(config)
     try:
-        jwt_token = encode(payload, private_key, algorithm=config.algorithm)
+        jwt_token = encode(
+            payload,
+            private_key,
+            algorithm=config.algorithm,
+            headers={"kid": VERIFICATION_TOKEN_KEY_ID},
+        )
         return jwt_token
     except Exception as error:
         raise JWTError(f"Failed to encode JWT token. Error: {error}") from error
 
 
 def redirect_to_client_app_using_verification_token(
-    verification_token: str, config: JWTConfig
+    verification_token: str, config: JWTConfig, session: dict = None
 ):
-    try:
-        return process_email_verification_token(verification_token, config)
-    except BlacklistedTokenError:
-        logging.exception("Token is blacklisted, trying without blacklist...")
-    except InvalidTokenError:
-        logging.error("Invalid token provided.")
-        raise
-
-    try:
-        _config = copy(config)
-        _config.token_blacklist = []
-        verification_decoded_token = decode_email_verification_token(
-            verification_token,
-            _config,
-        )
-        return redirect(verification_decoded_token[config.redirect_url_field])
-    except (InvalidTokenError, BlacklistedTokenError) as error:
-        raise InvalidEmailTokenError(
-            "Failed to decode client application token."
-        ) from error
+    """
+    Send a verification-link click on to the client app.
+
+    The first click hands the token to the client app, and remembers the verified
+    email in ``session`` if one is given; later clicks of the same link only
+    redirect to the client app.
+    """
+    decoded_token, fresh = consume_email_verification_token(verification_token, config)
+    redirect_url = decoded_token[config.redirect_url_field]
+    outcome = "fresh" if fresh else "reused"
+    metrics.increment("membrane_verification_clicks_total", result=outcome)
+    audit.record(
+        "verification_link_used",
+        outcome,
+        app_id=decoded_token.get(VERIFICATION_APP_ID_CLAIM),
+        email=decoded_token.get("sub"),
+    )
+    if fresh:
+        if session is not None:
+            session[VERIFIED_EMAIL_SESSION_KEY] = decoded_token["sub"]
+        return redirect(f"{redirect_url}?token={verification_token}", code=302)
+    logging.info("Verification token already used, redirecting without it.")
+    return redirect(redirect_url)
@@ -0,0 +1,120 @@
+"""
+Event loop lag monitor and blocking-call detector.
+
+A heartbeat task sleeps for ``interval_seconds`` at a time on the event loop; the
+time it oversleeps is the loop's lag, how long every other ready callback also had
+to wait. The recent lags are published as percentiles in the metrics.
+
+A watchdog thread checks the heartbeat. When the loop has not come back for
+``stall_threshold_seconds``, something is blocking it, and the watchdog logs the
+stack of the loop's thread while it is still blocked, so the stack shows the
+blocking call itself.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+
+import metrics
+
+DEFAULT_LOOP_MONITOR_INTERVAL_SECONDS = 0.1
+DEFAULT_LOOP_STALL_THRESHOLD_SECONDS = 0.5
+DEFAULT_LOOP_LAG_WINDOW = 600
+LOOP_LAG_QUANTILES = (0.5, 0.95, 0.99)
+
+
+@dataclass
+class LoopMonitorConfig:
+    interval_seconds: float = DEFAULT_LOOP_MONITOR_INTERVAL_SECONDS
+    stall_threshold_seconds: float = DEFAULT_LOOP_STALL_THRESHOLD_SECONDS
+    window: int = DEFAULT_LOOP_LAG_WINDOW
+
+
+class LoopMonitor:
+    def __init__(self, config: LoopMonitorConfig, logger: logging.Logger = None):
+        self.config = config
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._lags = deque(maxlen=config.window)
+        self._last_beat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start monitoring the running event loop."""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        self._thread = threading.Thread(
+            target=self._watch, name="membrane-loop-watchdog", daemon=True
+        )
+        self._thread.start()
+        for quantile in LOOP_LAG_QUANTILES:
+            metrics.register_gauge(
+                "membrane_loop_lag_seconds",
+                lambda quantile=quantile: self.lag_quantile(quantile),
+                quantile=quantile,
+            )
+        metrics.register_gauge("membrane_loop_lag_max_seconds", self.max_lag)
+
+    async def stop(self):
+        for quantile in LOOP_LAG_QUANTILES:
+            metrics.unregister_gauge("membrane_loop_lag_seconds", quantile=quantile)
+        metrics.unregister_gauge("membrane_loop_lag_max_seconds")
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+        self._task = self._thread = None
+
+    async def _beat(self):
+        interval = self.config.interval_seconds
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                self._lags.append(max(0.0, now - started - interval))
+                self._last_beat = now
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.config.interval_seconds):
+            last_beat = self._last_beat
+            blocked_for = time.monotonic() - last_beat - self.config.interval_seconds
+            if (
+                blocked_for < self.config.stall_threshold_seconds
+                or last_beat == reported_beat
+            ):
+                continue
+            # One report per stall, taken while the loop is still blocked.
+            reported_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            metrics.increment("membrane_loop_stalls_total")
+            self.logger.warning(
+                "Event loop blocked for at least %.3fs, in:\n%s", blocked_for, stack
+            )
+
+    def lag_quantile(self, quantile: float) -> float:
+        with self._lock:
+            lags = sorted(self._lags)
+        if not lags:
+            return 0.0
+        return lags[min(len(lags) - 1, int(len(lags) * quantile))]
+
+    def max_lag(self) -> float:
+        with self._lock:
+            return max(self._lags, default=0.0)
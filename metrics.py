@@ -0,0 +1,57 @@
+"""
+In-process counters and gauges, reported by the /admin/metrics endpoint.
+
+Values are per worker process. Counters are keyed by name and labels; gauges are
+callbacks evaluated when the metrics are read.
+"""
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    rendered = ",".join(f'{label}="{value}"' for label, value in sorted(labels.items()))
+    return f"{name}{{{rendered}}}"
+
+
+def increment(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += amount
+
+
+def counter_value(name, **labels):
+    with _lock:
+        return _counters[_key(name, labels)]
+
+
+def register_gauge(name, callback, **labels):
+    """Report ``callback()`` under ``name`` each time the metrics are read."""
+    _gauges[_key(name, labels)] = callback
+
+
+def unregister_gauge(name, **labels):
+    _gauges.pop(_key(name, labels), None)
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+    gauges = {}
+    for key, callback in list(_gauges.items()):
+        try:
+            gauges[key] = callback()
+        except Exception as error:
+            gauges[key] = f"error: {error}"
+    return {"counters": counters, "gauges": gauges}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+    _gauges.clear()
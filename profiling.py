@@ -0,0 +1,191 @@
+"""
+On-demand CPU and memory profiling of a running worker.
+
+CPU profiles are taken by a sampling thread that walks the stacks of every other
+thread at a fixed interval and writes them as collapsed stacks (the input format of
+flamegraph.pl and speedscope). Memory profiles are ``tracemalloc`` snapshots dumped
+in the standard format (``tracemalloc.Snapshot.load``), each diffed against the
+previous one to report the top allocators.
+"""
+import asyncio
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from os import getpid
+from pathlib import Path
+
+DEFAULT_PROFILE_DIRECTORY = "./profiles"
+DEFAULT_PROFILE_SECONDS = 10
+DEFAULT_PROFILE_MAX_SECONDS = 120
+DEFAULT_PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+DEFAULT_TRACEMALLOC_FRAMES = 10
+DEFAULT_TRACEMALLOC_TOP = 20
+
+
+class ProfilingError(Exception):
+    """Base class for profiling errors."""
+
+
+class ProfilerBusyError(ProfilingError):
+    """Raised when a CPU profile is requested while another one is running."""
+
+
+class InvalidProfileDurationError(ProfilingError):
+    """Raised when the requested profile duration is out of bounds."""
+
+
+@dataclass
+class ProfilingConfig:
+    output_directory: Path = Path(DEFAULT_PROFILE_DIRECTORY)
+    default_seconds: float = DEFAULT_PROFILE_SECONDS
+    max_seconds: float = DEFAULT_PROFILE_MAX_SECONDS
+    sample_interval_seconds: float = DEFAULT_PROFILE_SAMPLE_INTERVAL_SECONDS
+    tracemalloc_frames: int = DEFAULT_TRACEMALLOC_FRAMES
+    tracemalloc_top: int = DEFAULT_TRACEMALLOC_TOP
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+
+def _collapse(frame, thread_name):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+class Profiler:
+    def __init__(self, config: ProfilingConfig):
+        self.config = config
+        self._cpu_lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+        self._last_snapshot = None
+
+    def _output_path(self, kind, suffix):
+        self.config.output_directory.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        return self.config.output_directory / f"{kind}-{getpid()}-{timestamp}{suffix}"
+
+    def profile_cpu(self, seconds: float = None) -> dict:
+        """
+        Sample every thread's stack for ``seconds`` and write collapsed stacks.
+
+        Blocks the calling thread for the duration; run it off the event loop.
+        """
+        seconds = self.config.default_seconds if seconds is None else seconds
+        if not 0 < seconds <= self.config.max_seconds:
+            raise InvalidProfileDurationError(
+                f"Profile duration must be between 0 and {self.config.max_seconds} "
+                "seconds."
+            )
+        if not self._cpu_lock.acquire(blocking=False):
+            raise ProfilerBusyError("A CPU profile is already running.")
+        try:
+            stacks = Counter()
+            samples = 0
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        stacks[_collapse(frame, names.get(thread_id, "thread"))] += 1
+                samples += 1
+                time.sleep(self.config.sample_interval_seconds)
+        finally:
+            self._cpu_lock.release()
+
+        path = self._output_path("cpu", ".folded")
+        with path.open("w") as profile_file:
+            for stack, count in stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+        return {"path": str(path), "seconds": seconds, "samples": samples}
+
+    def snapshot_memory(self) -> dict:
+        """
+        Dump a tracemalloc snapshot and diff it against the previous one.
+
+        The first call starts tracemalloc, so its diff is taken against an empty
+        baseline.
+        """
+        with self._memory_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.config.tracemalloc_frames)
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),)
+            )
+            path = self._output_path("memory", ".tracemalloc")
+            snapshot.dump(str(path))
+
+            previous, self._last_snapshot = self._last_snapshot, snapshot
+            if previous is None:
+                stats = snapshot.statistics("lineno")
+            else:
+                stats = snapshot.compare_to(previous, "lineno")
+            current, peak = tracemalloc.get_traced_memory()
+
+        return {
+            "path": str(path),
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {
+                    "location": str(stat.traceback[0]),
+                    "size_bytes": stat.size,
+                    "size_diff_bytes": getattr(stat, "size_diff", stat.size),
+                    "count": stat.count,
+                    "count_diff": getattr(stat, "count_diff", stat.count),
+                }
+                for stat in stats[: self.config.tracemalloc_top]
+            ],
+        }
+
+    def stop_memory_tracing(self):
+        with self._memory_lock:
+            self._last_snapshot = None
+            tracemalloc.stop()
+
+
+def install_signal_handlers(profiler: Profiler, logger):
+    """
+    Profile on SIGUSR1 (CPU, default duration) and SIGUSR2 (memory snapshot).
+
+    Must be called from the running event loop. Does nothing on platforms without
+    POSIX signals.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    def run_in_background(func, description):
+        async def run():
+            try:
+                result = await asyncio.to_thread(func)
+                logger.info("%s written to %s", description, result["path"])
+            except ProfilingError as error:
+                logger.warning("%s skipped: %s", description, error)
+
+        task = loop.create_task(run())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    try:
+        loop.add_signal_handler(
+            signal.SIGUSR1, run_in_background, profiler.profile_cpu, "CPU profile"
+        )
+        loop.add_signal_handler(
+            signal.SIGUSR2,
+            run_in_background,
+            profiler.snapshot_memory,
+            "Memory snapshot",
+        )
+    except (AttributeError, NotImplementedError):
+        logger.warning("Profiling signals are not supported on this platform.")
@@ -0,0 +1,100 @@
+"""
+JSON serialization for requests and responses.
+
+``OrjsonProvider`` serializes with orjson when it is installed, and falls back to
+the standard library for what orjson cannot handle, or when it is missing.
+
+``ResponseBodies`` holds the bodies of the responses that only depend on the
+configuration, serialized once per configuration snapshot, so that the requests
+answered with them do not build and encode a dictionary each time.
+"""
+import json
+from dataclasses import dataclass
+
+from quart import current_app
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+INVALID_REQUEST_MESSAGE = "Invalid request method"
+
+
+def _dumps_bytes(obj, default=None, sort_keys=False) -> bytes:
+    """Compact JSON with a trailing newline, the body ``jsonify`` would produce."""
+    if orjson is not None:
+        # Datetimes and dataclasses go through ``default`` as with the stdlib.
+        option = (
+            orjson.OPT_APPEND_NEWLINE
+            | orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            # Integers over 64 bits, non-string keys and the like.
+            pass
+    return (
+        json.dumps(obj, default=default, sort_keys=sort_keys, separators=(",", ":"))
+        + "\n"
+    ).encode()
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Quart's JSON provider, serializing with orjson when possible."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return _dumps_bytes(obj, self.default, self.sort_keys)[:-1].decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        # orjson.JSONDecodeError is a json.JSONDecodeError, as callers expect.
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if (
+            orjson is None
+            or self.compact is False
+            or (self.compact is None and self._app.debug)
+        ):
+            # The indented output is left to the stdlib.
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            _dumps_bytes(obj, self.default, self.sort_keys), mimetype=self.mimetype
+        )
+
+
+@dataclass(frozen=True)
+class ResponseBodies:
+    email_sent: bytes
+    email_unavailable: bytes
+    invalid_request: bytes
+    generic_error: bytes
+
+
+def build_response_bodies(
+    email_send_success: str,
+    email_unavailable: str,
+    generic_error_field: str,
+    generic_error: str,
+) -> ResponseBodies:
+    return ResponseBodies(
+        email_sent=_dumps_bytes({"message": email_send_success}),
+        email_unavailable=_dumps_bytes({"error": email_unavailable}),
+        invalid_request=_dumps_bytes({"error": INVALID_REQUEST_MESSAGE}),
+        generic_error=_dumps_bytes({generic_error_field: generic_error}),
+    )
+
+
+def json_response(body: bytes, status: int):
+    """Response with a body serialized ahead of time."""
+    return current_app.response_class(body, status=status, mimetype=JSON_MIMETYPE)
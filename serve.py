@@ -0,0 +1,302 @@
+"""
+Pre-fork entry point serving the Membrane Backend with hypercorn.
+
+``hypercorn --workers N`` spawns fresh interpreters, and each one imports the app
+and runs ``create_app`` on its own: the environment is parsed, the key files are
+validated and parsed and the clients are built N times. This entry point does that
+setup once in the parent, moves the resulting objects out of the garbage
+collector's reach and forks the workers, which then share them copy-on-write.
+
+Workers run on uvloop when it is installed, one per CPU of the container's quota
+with MEMBRANE_WORKERS=auto, with the hypercorn settings of the
+MEMBRANE_SERVING_PROFILE profile.
+"""
+import gc
+import logging
+import math
+import os
+import signal
+import sys
+import time
+from dataclasses import dataclass
+from importlib import import_module
+from importlib.util import find_spec
+from pathlib import Path
+
+from hypercorn.asyncio.run import asyncio_worker, uvloop_worker
+from hypercorn.config import Config
+from hypercorn.run import run as hypercorn_run
+
+from app_create import reload_config
+
+DEFAULT_PORT = 5000
+DEFAULT_WORKERS = "1"
+DEFAULT_EVENT_LOOP = "auto"
+DEFAULT_SERVING_PROFILE = "default"
+DEFAULT_APPLICATION_PATH = "app:app"
+DEFAULT_CGROUP_ROOT = Path("/sys/fs/cgroup")
+WORKER_RESPAWN_DELAY_SECONDS = 1
+EVENT_LOOPS = ("auto", "uvloop", "asyncio")
+PROFILING_SIGNALS = tuple(
+    getattr(signal, name) for name in ("SIGUSR1", "SIGUSR2") if hasattr(signal, name)
+)
+
+logger = logging.getLogger("membrane.serve")
+
+
+@dataclass(frozen=True)
+class ServingProfile:
+    """hypercorn settings tuned together; see "Serving Profiles" in the README."""
+
+    backlog: int
+    keep_alive_timeout: float
+    graceful_timeout: float
+    max_requests: int = None
+    max_requests_jitter: int = 0
+    keep_alive_max_requests: int = 1000
+    h11_max_incomplete_size: int = 16 * 1024
+    h2_max_concurrent_streams: int = 100
+
+
+SERVING_PROFILES = {
+    # hypercorn's own defaults.
+    "default": ServingProfile(
+        backlog=100,
+        keep_alive_timeout=5,
+        graceful_timeout=3,
+    ),
+    # Behind a load balancer: a deeper accept queue for bursts, keep-alive outliving
+    # the balancer's idle timeout (60s on most) so it never reuses a connection the
+    # worker is closing, workers recycled to cap memory growth, and time for
+    # background email sends to finish on shutdown.
+    "tuned": ServingProfile(
+        backlog=2048,
+        keep_alive_timeout=75,
+        graceful_timeout=30,
+        max_requests=100_000,
+        max_requests_jitter=10_000,
+        keep_alive_max_requests=10_000,
+        h11_max_incomplete_size=8 * 1024,
+        h2_max_concurrent_streams=256,
+    ),
+}
+
+
+def read_cgroup_cpu_quota(cgroup_root: Path = DEFAULT_CGROUP_ROOT):
+    """
+    Return the CPU quota of this process's cgroup in CPUs, or None if unlimited.
+
+    Containers limited with ``--cpus`` (or a Kubernetes CPU limit) still see every
+    host CPU in ``os.cpu_count()``; the quota is the number they may actually use.
+    """
+    try:
+        # cgroup v2: "<quota> <period>", or "max <period>" when unlimited.
+        quota, period = (cgroup_root / "cpu.max").read_text().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        return None
+
+    for controller in ("cpu", "cpu,cpuacct"):
+        try:
+            # cgroup v1: a quota of -1 means unlimited.
+            quota = int((cgroup_root / controller / "cpu.cfs_quota_us").read_text())
+            period = int((cgroup_root / controller / "cpu.cfs_period_us").read_text())
+        except (OSError, ValueError):
+            continue
+        return quota / period if quota > 0 and period > 0 else None
+    return None
+
+
+def available_cpus(cgroup_root: Path = DEFAULT_CGROUP_ROOT) -> float:
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = read_cgroup_cpu_quota(cgroup_root)
+    return min(cpus, quota) if quota else cpus
+
+
+def resolve_workers(workers: str, cgroup_root: Path = DEFAULT_CGROUP_ROOT) -> int:
+    """One worker per available CPU for "auto", rounding a fractional quota up."""
+    if workers == "auto":
+        return max(1, math.ceil(available_cpus(cgroup_root)))
+    return int(workers)
+
+
+def resolve_event_loop(event_loop: str) -> str:
+    """Return the hypercorn worker class for "auto", "uvloop" or "asyncio"."""
+    if event_loop not in EVENT_LOOPS:
+        raise ValueError(
+            f"Invalid MEMBRANE_EVENT_LOOP {event_loop}, expected one of "
+            f"{', '.join(EVENT_LOOPS)}."
+        )
+    uvloop_available = find_spec("uvloop") is not None
+    if event_loop == "uvloop" and not uvloop_available:
+        raise ValueError("MEMBRANE_EVENT_LOOP is uvloop but uvloop is not installed.")
+    if event_loop == "auto":
+        return "uvloop" if uvloop_available else "asyncio"
+    return event_loop
+
+
+def build_hypercorn_config() -> Config:
+    profile_name = os.getenv("MEMBRANE_SERVING_PROFILE", DEFAULT_SERVING_PROFILE)
+    if profile_name not in SERVING_PROFILES:
+        raise ValueError(
+            f"Invalid MEMBRANE_SERVING_PROFILE {profile_name}, expected one of "
+            f"{', '.join(SERVING_PROFILES)}."
+        )
+    profile = SERVING_PROFILES[profile_name]
+
+    config = Config()
+    config.application_path = DEFAULT_APPLICATION_PATH
+    config.bind = [f":{os.getenv('PORT', DEFAULT_PORT)}"]
+    config.workers = resolve_workers(os.getenv("MEMBRANE_WORKERS", DEFAULT_WORKERS))
+    config.worker_class = resolve_event_loop(
+        os.getenv("MEMBRANE_EVENT_LOOP", DEFAULT_EVENT_LOOP)
+    )
+    config.backlog = int(os.getenv("MEMBRANE_BACKLOG", profile.backlog))
+    config.keep_alive_timeout = float(
+        os.getenv("MEMBRANE_KEEP_ALIVE", profile.keep_alive_timeout)
+    )
+    config.graceful_timeout = float(
+        os.getenv("MEMBRANE_GRACEFUL_TIMEOUT", profile.graceful_timeout)
+    )
+    max_requests = os.getenv("MEMBRANE_MAX_REQUESTS", profile.max_requests)
+    config.max_requests = int(max_requests) if max_requests else None
+    config.max_requests_jitter = int(
+        os.getenv("MEMBRANE_MAX_REQUESTS_JITTER", profile.max_requests_jitter)
+    )
+    config.keep_alive_max_requests = profile.keep_alive_max_requests
+    config.h11_max_incomplete_size = profile.h11_max_incomplete_size
+    config.h2_max_concurrent_streams = profile.h2_max_concurrent_streams
+    return config
+
+
+def load_application(application_path: str):
+    """Import the application in this process so forked workers inherit it."""
+    module_name, app_name = application_path.split(":", 1)
+    return getattr(import_module(module_name), app_name)
+
+
+class PreforkServer:
+    """Fork hypercorn workers from a parent holding the initialized application."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.app = None
+        self.sockets = None
+        self.workers = set()
+        self.stopping = False
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                    signal.signal(signum, signal.SIG_DFL)
+                # Until the worker installs its own reload and profiling handlers
+                # on startup.
+                for signum in PROFILING_SIGNALS + (signal.SIGHUP,):
+                    signal.signal(signum, signal.SIG_IGN)
+                # The application is already imported, so hypercorn's loader
+                # finds it in sys.modules instead of running create_app again.
+                if self.config.worker_class == "uvloop":
+                    uvloop_worker(self.config, self.sockets)
+                else:
+                    asyncio_worker(self.config, self.sockets)
+            except BaseException:
+                logger.exception("Worker %d crashed.", os.getpid())
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.workers.add(pid)
+        logger.info("Started worker %d.", pid)
+
+    def signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reload(self, signum, frame):
+        """Reload in the parent too, so that replacement workers inherit it."""
+        try:
+            reload_config(self.app)
+        except Exception:
+            logger.exception("Configuration reload failed, keeping current one.")
+            return
+        self.signal_workers(signal.SIGHUP)
+
+    def forward(self, signum, frame):
+        self.signal_workers(signum)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def run(self) -> int:
+        self.app = load_application(self.config.application_path)
+        self.sockets = self.config.create_sockets()
+        logger.info(
+            "Serving with %d %s workers, backlog %d, keep-alive %ss, "
+            "max requests %s, graceful timeout %ss.",
+            self.config.workers,
+            self.config.worker_class,
+            self.config.backlog,
+            self.config.keep_alive_timeout,
+            self.config.max_requests,
+            self.config.graceful_timeout,
+        )
+
+        # Objects created so far are never freed; keep the collector from touching
+        # (and so un-sharing) their pages in the workers.
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        # Each worker profiles itself; by default these signals would kill the parent.
+        for signum in PROFILING_SIGNALS:
+            signal.signal(signum, self.forward)
+        for _ in range(max(self.config.workers, 1)):
+            self.spawn_worker()
+
+        exit_code = 0
+        while self.workers:
+            pid, status = os.wait()
+            self.workers.discard(pid)
+            worker_exit_code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                exit_code = exit_code or worker_exit_code
+                continue
+            if worker_exit_code == 0:
+                # Recycled after serving MEMBRANE_MAX_REQUESTS requests.
+                logger.info("Worker %d exited, starting a replacement.", pid)
+                self.spawn_worker()
+                continue
+            logger.warning(
+                "Worker %d exited with code %d, starting a replacement.",
+                pid,
+                worker_exit_code,
+            )
+            time.sleep(WORKER_RESPAWN_DELAY_SECONDS)
+            if not self.stopping:
+                self.spawn_worker()
+        return exit_code
+
+
+def main() -> int:
+    config = build_hypercorn_config()
+    if not hasattr(os, "fork"):
+        logger.warning("fork() is unavailable, falling back to hypercorn workers.")
+        return hypercorn_run(config)
+    return PreforkServer(config).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
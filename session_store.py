@@ -0,0 +1,204 @@
+"""
+Server-side session backends for Quart-Session.
+
+Adds two backends to the ones Quart-Session ships with:
+
+- ``memory``: a per-worker dictionary with LRU eviction and a TTL of
+  PERMANENT_SESSION_LIFETIME. Nothing to run next to the app, but each worker only
+  knows the sessions it created.
+- ``sqlite``: a SQLite database shared by all the workers of a host, in WAL mode so
+  that readers do not wait on writers.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from quart import Quart
+from quart_session import Session
+from quart_session.sessions import ServerSideSession, SessionInterface
+
+DEFAULT_SESSION_MAX_ENTRIES = 10000
+DEFAULT_SESSION_SQLITE_FILE = "./sessions.sqlite3"
+# Expired rows are deleted once every this many writes.
+SQLITE_PRUNE_INTERVAL = 100
+SQLITE_BUSY_TIMEOUT_SECONDS = 5
+
+
+def lifetime_seconds(app: Quart) -> float:
+    return app.permanent_session_lifetime.total_seconds()
+
+
+class MemorySession(ServerSideSession):
+    pass
+
+
+class SQLiteSession(ServerSideSession):
+    pass
+
+
+class MemorySessionInterface(SessionInterface):
+    """Sessions kept in the worker's memory, least recently used evicted first."""
+
+    session_class = MemorySession
+
+    def __init__(self, max_entries: int = DEFAULT_SESSION_MAX_ENTRIES, **kwargs):
+        super().__init__(**kwargs)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    async def create(self, app: Quart):
+        pass
+
+    async def get(self, key: str, app: Quart = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value, expiry: int = None, app: Quart = None):
+        if app and not expiry:
+            expiry = lifetime_seconds(app)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def delete(self, key: str, app: Quart = None):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """Sessions in a SQLite file shared by the workers of a host."""
+
+    session_class = SQLiteSession
+
+    def __init__(self, path: Path = Path(DEFAULT_SESSION_SQLITE_FILE), **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not cross fork(); each worker opens its own.
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path,
+                timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def _execute(self, statement: str, parameters=()):
+        with self._lock:
+            return self._connect().execute(statement, parameters).fetchone()
+
+    def _get(self, key):
+        row = self._execute(
+            "SELECT value FROM sessions WHERE key = ? AND expires_at >= ?",
+            (key, time.time()),
+        )
+        return row[0] if row else None
+
+    def _set(self, key, value, expiry):
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + expiry),
+        )
+        self._writes += 1
+        if self._writes % SQLITE_PRUNE_INTERVAL == 0:
+            self._execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),))
+
+    async def create(self, app: Quart):
+        await asyncio.to_thread(self._connect)
+
+    async def get(self, key: str, app: Quart = None):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value, expiry: int = None, app: Quart = None):
+        if app and not expiry:
+            expiry = lifetime_seconds(app)
+        await asyncio.to_thread(self._set, key, value, expiry)
+
+    async def delete(self, key: str, app: Quart = None):
+        await asyncio.to_thread(
+            self._execute, "DELETE FROM sessions WHERE key = ?", (key,)
+        )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
+
+
+class MembraneSession(Session):
+    """Quart-Session with the ``memory`` and ``sqlite`` backends added."""
+
+    def init_app(self, app: Quart):
+        super().init_app(app)
+
+        @app.after_serving
+        async def close_session_store():
+            if isinstance(app.session_interface, SQLiteSessionInterface):
+                app.session_interface.close()
+
+    def _get_interface(self, app: Quart):
+        session_type = app.config.get("SESSION_TYPE")
+        if session_type not in ("memory", "sqlite"):
+            return super()._get_interface(app)
+
+        config = {
+            "SESSION_PROTECTION": False,
+            "SESSION_REVERSE_PROXY": False,
+            "SESSION_STATIC_FILE": False,
+            **{
+                key: value
+                for key, value in app.config.items()
+                if key.startswith("SESSION_")
+            },
+        }
+        options = {
+            "key_prefix": config.get("SESSION_KEY_PREFIX", "session:"),
+            "use_signer": config.get("SESSION_USE_SIGNER", False),
+            "permanent": config.get("SESSION_PERMANENT", True),
+            **config,
+        }
+        if session_type == "memory":
+            return MemorySessionInterface(
+                max_entries=config.get(
+                    "SESSION_MAX_ENTRIES", DEFAULT_SESSION_MAX_ENTRIES
+                ),
+                **options,
+            )
+        return SQLiteSessionInterface(
+            path=Path(config.get("SESSION_SQLITE_FILE", DEFAULT_SESSION_SQLITE_FILE)),
+            **options,
+        )
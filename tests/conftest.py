@@ -15,6 +15,13 @@ with patch("app_create.create_app") as mock_create_app:
     mock_create_app.return_value = Quart(__name__)
     from app import app
 
+from responses import OrjsonProvider, build_response_bodies  # noqa: E402
+from session_store import MembraneSession  # noqa: E402
+
+app.json = OrjsonProvider(app)
+app.config["SESSION_TYPE"] = "memory"
+MembraneSession(app)
+
 from emails import EmailConfig  # noqa: E402
 from jwt_utils import JWTConfig, generate_email_verification_token  # noqa: E402
 
@@ -50,14 +57,12 @@ class TestConfig(unittest.TestCase):
     @classmethod
     def setup_email_config(cls):
         return EmailConfig(
-            email_client=None,
+            transport=None,
             sender_email="",
             subject="Please Verify You Email Address",
             validation_pattern="^[a-zA-Z0-9._+]+@(?:gc\.ca|canada\.ca|inspection\.gc\.ca)$",
             email_send_success="Valid email address, Email sent with JWT link",
             html_content="<html><h1>{}</h1></html>",
-            poller_wait_seconds=2,
-            timeout=20,
         )
 
     def setUp(self):
@@ -77,6 +82,12 @@ class TestConfig(unittest.TestCase):
     def setup_app(self):
         self.app.config["JWT_CONFIG"] = self.jwt_config
         self.app.config["EMAIL_CONFIG"] = self.email_config
+        self.app.config["RESPONSE_BODIES"] = build_response_bodies(
+            self.email_config.email_send_success,
+            self.email_config.email_unavailable,
+            "error",
+            "An unexpected error occurred. Please try again later.",
+        )
         self.app.config["TESTING"] = True
         self.app.config["SERVER_NAME"] = "login.example.com"
         self.app.config["MEMBRANE_FRONTEND"] = "membrane-frontend.ca"
@@ -0,0 +1,205 @@
+"""
+Tests for the audit trail of verification link requests and uses.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from conftest import TestConfig
+
+import audit
+import metrics
+from app_create import load_audit_config
+from audit import AuditConfig, AuditLog, RotatingJSONLWriter
+
+
+def read_records(path: Path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+class BlockedWriter:
+    """Writer holding the first batch until released, so that the queue fills."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.batches = []
+
+    def write(self, lines):
+        self.release.wait()
+        self.batches.append(lines)
+
+    def close(self):
+        pass
+
+
+class TestAuditLog(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "audit.jsonl"
+        metrics.reset()
+
+    def test_records_are_written_with_hashed_email(self):
+        audit_log = AuditLog(AuditConfig(self.path, b"key"))
+        for outcome in ("accepted", "fresh"):
+            audit_log.record("event", outcome, app_id="testapp1", email="A@gc.ca ")
+        audit_log.shutdown()
+
+        records = read_records(self.path)
+        self.assertEqual(
+            [record["outcome"] for record in records], ["accepted", "fresh"]
+        )
+        self.assertEqual(records[0]["app_id"], "testapp1")
+        self.assertEqual(records[0]["email_hash"], audit_log.hash_email("a@gc.ca"))
+        self.assertNotIn("gc.ca", self.path.read_text())
+        self.assertEqual(metrics.counter_value("membrane_audit_written_total"), 2)
+
+    def test_full_queue_drops_and_counts(self):
+        writer = BlockedWriter()
+        audit_log = AuditLog(AuditConfig(self.path, b"key", queue_size=2), writer)
+        results = [audit_log.record("event", "accepted") for _ in range(10)]
+        self.assertIn(False, results)
+        self.assertEqual(audit_log.dropped, results.count(False))
+        self.assertEqual(
+            metrics.counter_value("membrane_audit_dropped_total"), audit_log.dropped
+        )
+        self.assertLessEqual(audit_log.backlog, 2)
+
+        writer.release.set()
+        audit_log.shutdown()
+        written = sum(len(batch) for batch in writer.batches)
+        self.assertEqual(written, results.count(True))
+
+    def test_file_is_rotated_by_size(self):
+        writer = RotatingJSONLWriter(self.path, max_bytes=100, backup_count=2)
+        for index in range(5):
+            writer.write(
+                [json.dumps({"index": index, "padding": "x" * 60}).encode() + b"\n"]
+            )
+        writer.close()
+
+        self.assertEqual(
+            sorted(path.name for path in self.path.parent.glob("audit.jsonl*")),
+            ["audit.jsonl", "audit.jsonl.1", "audit.jsonl.2", "audit.jsonl.lock"],
+        )
+        self.assertIn('"index": 4', self.path.read_text())
+        self.assertIn('"index": 3', Path(f"{self.path}.1").read_text())
+
+    def test_writer_follows_rotation_by_another_process(self):
+        first = RotatingJSONLWriter(self.path, max_bytes=100, backup_count=1)
+        second = RotatingJSONLWriter(self.path, max_bytes=100, backup_count=1)
+        second.write([b"a" * 60 + b"\n"])
+        first.write([b"b" * 60 + b"\n"])
+        second.write([b"c" * 10 + b"\n"])
+        first.close()
+        second.close()
+
+        self.assertEqual(self.path.read_text(), "b" * 60 + "\n" + "c" * 10 + "\n")
+
+    def test_writer_without_fcntl_writes_unlocked(self):
+        writer = RotatingJSONLWriter(self.path, max_bytes=100, backup_count=1)
+        with patch("audit.fcntl", None):
+            writer.write([b"a" * 60 + b"\n"])
+            writer.write([b"b" * 60 + b"\n"])
+        writer.close()
+
+        self.assertEqual(self.path.read_text(), "b" * 60 + "\n")
+        self.assertFalse(Path(f"{self.path}.lock").exists())
+
+    def test_unconfigured_audit_is_a_no_op(self):
+        audit.shutdown()
+        audit.record("event", "accepted", email="a@gc.ca")
+        self.assertIsNone(audit.get_audit_log())
+
+
+class TestAuthenticationAudit(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "audit.jsonl"
+        audit.configure(AuditConfig(self.path, b"key"))
+        self.addCleanup(audit.shutdown)
+
+    @patch("app.send_email")
+    async def test_request_and_use_of_verification_link(self, mock_send_email):
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.post(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@inspection.gc.ca"},
+        )
+        self.assertEqual(response.status_code, 200)
+        await asyncio.gather(*self.app.background_tasks)
+
+        verification_url = mock_send_email.call_args.args[1]
+        response = await self.test_client.get(verification_url)
+        self.assertEqual(response.status_code, 302)
+        audit.shutdown()
+
+        email_hash = hmac.new(
+            b"key", b"test@inspection.gc.ca", hashlib.sha256
+        ).hexdigest()
+        records = read_records(self.path)
+        self.assertEqual(
+            [(record["event"], record["outcome"]) for record in records],
+            [
+                ("verification_requested", "accepted"),
+                ("verification_email", "sent"),
+                ("verification_link_used", "fresh"),
+            ],
+        )
+        for record in records:
+            self.assertEqual(record["app_id"], "testapp1")
+            self.assertEqual(record["email_hash"], email_hash)
+
+    async def test_invalid_email_is_audited(self):
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        await self.test_client.post(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@example.com"},
+        )
+        audit.shutdown()
+        [record] = read_records(self.path)
+        self.assertEqual(record["outcome"], "invalid_email")
+        self.assertIsNone(record["email_hash"])
+
+
+class TestAuditConfig(unittest.TestCase):
+    def load(self, environment):
+        with patch.dict(os.environ, environment):
+            for key in ("MEMBRANE_AUDIT_HASH_KEY", "MEMBRANE_SECRET_KEY"):
+                if key not in environment:
+                    os.environ.pop(key, None)
+            return load_audit_config()
+
+    def test_hash_key_falls_back_to_secret_key(self):
+        self.assertEqual(
+            self.load({"MEMBRANE_SECRET_KEY": "secret"}).hash_key, b"secret"
+        )
+        self.assertEqual(
+            self.load(
+                {"MEMBRANE_SECRET_KEY": "secret", "MEMBRANE_AUDIT_HASH_KEY": "key"}
+            ).hash_key,
+            b"key",
+        )
+
+    def test_missing_hash_key_is_a_clear_error(self):
+        with self.assertRaisesRegex(ValueError, "MEMBRANE_AUDIT_HASH_KEY"):
+            self.load({})
+        self.assertIsNone(self.load({"MEMBRANE_AUDIT_FILE": ""}).file_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
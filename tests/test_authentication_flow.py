@@ -4,9 +4,14 @@
 from datetime import datetime, timedelta
 from unittest import IsolatedAsyncioTestCase
 from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
 
+import jwt
 from conftest import TestConfig
 
+import jwt_utils
+import metrics
+
 
 class TestAuthenticationFlow(TestConfig, IsolatedAsyncioTestCase):
     async def test_missing_token_returns_405_method_not_allowed(self):
@@ -30,7 +35,7 @@ class TestAuthenticationFlow(TestConfig, IsolatedAsyncioTestCase):
         sample_jwt_token = self.generate_jwt_token(
             self.payload, self.jwt_config, "testapp1"
         )
-        response = await self.test_client.get(
+        response = await self.test_client.post(
             f"/authenticate?token={sample_jwt_token}",
             json={"email": "test@inspection.gc.ca"},
         )
@@ -40,7 +45,7 @@ class TestAuthenticationFlow(TestConfig, IsolatedAsyncioTestCase):
         sample_jwt_token = self.generate_jwt_token(
             self.payload, self.jwt_config, "testapp1"
         )
-        response = await self.test_client.get(
+        response = await self.test_client.post(
             f"/authenticate?token={sample_jwt_token}",
             json={"email": "test@inspection.g.ca"},
         )
@@ -66,3 +71,98 @@ class TestAuthenticationFlow(TestConfig, IsolatedAsyncioTestCase):
             sample_verification_token + "invalid_string"
         )
         self.assertEqual(response.status_code, 405)
+
+    async def test_verification_token_identifies_itself(self):
+        sample_verification_token = await self.sample_verification_token()
+        token = parse_qs(urlparse(sample_verification_token).query)["token"][0]
+        header = jwt.get_unverified_header(token)
+        self.assertEqual(header["kid"], jwt_utils.VERIFICATION_TOKEN_KEY_ID)
+        self.assertEqual(jwt_utils.token_kind(header), jwt_utils.VERIFICATION_TOKEN)
+        payload = jwt.decode(token, options={"verify_signature": False})
+        self.assertEqual(payload["iss"], jwt_utils.VERIFICATION_TOKEN_ISSUER)
+
+    async def test_each_token_kind_runs_one_verification(self):
+        sample_verification_token = await self.sample_verification_token()
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        with patch(
+            "jwt_utils.decode_client_jwt_token",
+            wraps=jwt_utils.decode_client_jwt_token,
+        ) as decode_client, patch(
+            "jwt_utils.verify_email_verification_token",
+            wraps=jwt_utils.verify_email_verification_token,
+        ) as verify:
+            response = await self.test_client.get(sample_verification_token)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual((decode_client.call_count, verify.call_count), (0, 1))
+
+            response = await self.test_client.get(
+                f"/authenticate?token={sample_jwt_token}"
+            )
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual((decode_client.call_count, verify.call_count), (1, 1))
+
+    async def test_invalid_client_jwt_is_not_retried_as_verification_token(self):
+        self.payload.update({self.jwt_config.app_id_field: "unknown"})
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "unknown"
+        )
+        with patch(
+            "jwt_utils.verify_email_verification_token",
+            wraps=jwt_utils.verify_email_verification_token,
+        ) as verify:
+            response = await self.test_client.get(
+                f"/authenticate?token={sample_jwt_token}"
+            )
+        self.assertEqual(response.status_code, 405)
+        verify.assert_not_called()
+
+    async def test_get_and_post_report_the_same_client_token_error(self):
+        metrics.reset()
+        self.payload.update({self.jwt_config.app_id_field: "unknown"})
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "unknown"
+        )
+        response = await self.test_client.get(f"/authenticate?token={sample_jwt_token}")
+        self.assertEqual(response.status_code, 405)
+        response = await self.test_client.post(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@inspection.gc.ca"},
+        )
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(
+            metrics.counter_value(
+                "membrane_token_invalid_total",
+                kind=jwt_utils.CLIENT_TOKEN,
+                error="JWTPublicKeyNotFoundError",
+            ),
+            2,
+        )
+
+    async def test_client_jwt_without_redirect_url_is_rejected(self):
+        del self.payload[self.jwt_config.redirect_url_field]
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.get(f"/authenticate?token={sample_jwt_token}")
+        self.assertEqual(response.status_code, 405)
+
+    @patch("app.app.add_background_task")
+    async def test_email_is_not_submitted_with_get(self, mock_add_background_task):
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.get(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@inspection.gc.ca"},
+        )
+        self.assertEqual(response.status_code, 302)
+        mock_add_background_task.assert_not_called()
+
+    async def test_verification_token_cannot_submit_email(self):
+        sample_verification_token = await self.sample_verification_token()
+        response = await self.test_client.post(
+            sample_verification_token, json={"email": "test@inspection.gc.ca"}
+        )
+        self.assertEqual(response.status_code, 405)
@@ -0,0 +1,203 @@
+"""
+Tests for the circuit breaker around the email provider.
+"""
+import unittest
+from dataclasses import replace
+from logging import getLogger
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from conftest import TestConfig
+
+import metrics
+from circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitBreakerConfig,
+)
+from emails import (
+    EmailProviderUnavailableError,
+    EmailSendingFailedError,
+    EmailTransport,
+    send_email,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FailingTransport(EmailTransport):
+    def __init__(self):
+        self.sends = 0
+
+    async def send(self, message, logger):
+        self.sends += 1
+        raise EmailSendingFailedError("provider is down")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            "test",
+            CircuitBreakerConfig(
+                window_size=4,
+                minimum_calls=4,
+                failure_ratio=0.5,
+                slow_call_seconds=10,
+                open_seconds=30,
+            ),
+            clock=self.clock,
+        )
+
+    def call(self, success=True, duration=0.1):
+        admission = self.breaker.allow_request()
+        self.assertIsNotNone(admission)
+        self.breaker.record(admission, success, duration)
+
+    def test_opens_once_failure_ratio_is_reached(self):
+        self.call()
+        self.call()
+        self.call(success=False)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.call(success=False)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertIsNone(self.breaker.allow_request())
+        self.assertEqual(self.breaker.retry_after, 30)
+        self.assertEqual(
+            metrics.counter_value("membrane_circuit_rejected_total", circuit="test"),
+            1,
+        )
+
+    def test_slow_calls_count_as_failures(self):
+        for _ in range(4):
+            self.call(duration=11)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_only_recent_calls_count(self):
+        self.call(success=False)
+        for _ in range(4):
+            self.call()
+        self.call(success=False)
+        self.assertEqual(self.breaker.state, CLOSED)
+        # Two failures out of the last four calls, though only three out of seven.
+        self.call(success=False)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_half_open_probe_closes_or_reopens(self):
+        for _ in range(4):
+            self.call(success=False)
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+        probe = self.breaker.allow_request()
+        self.assertIsNotNone(probe)
+        self.assertIsNone(self.breaker.allow_request())
+        self.breaker.record(probe, False, 0.1)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        self.clock.now += 30
+        self.call()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(
+            metrics.counter_value(
+                "membrane_circuit_transitions_total", circuit="test", state=OPEN
+            ),
+            2,
+        )
+
+    def test_only_the_probe_decides_a_half_open_breaker(self):
+        late = self.breaker.allow_request()
+        for _ in range(4):
+            self.call(success=False)
+        self.clock.now += 30
+        probe = self.breaker.allow_request()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+        # Admitted while closed, this success says nothing about the provider now.
+        self.breaker.record(late, True, 0.1)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertIsNone(self.breaker.allow_request())
+
+        self.breaker.record(probe, False, 0.1)
+        self.assertEqual(self.breaker.state, OPEN)
+
+
+class TestEmailCircuitBreaker(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.transport = FailingTransport()
+        self.app.config["EMAIL_CONFIG"] = replace(
+            self.email_config,
+            transport=self.transport,
+            breaker=CircuitBreaker(
+                "email", CircuitBreakerConfig(minimum_calls=2, open_seconds=60)
+            ),
+        )
+
+    async def test_open_breaker_fails_sends_fast(self):
+        config = self.app.config["EMAIL_CONFIG"]
+        for _ in range(2):
+            with self.assertRaises(EmailSendingFailedError):
+                await send_email("a@gc.ca", "body", config, getLogger("testLogger"))
+        with self.assertRaises(EmailProviderUnavailableError):
+            await send_email("a@gc.ca", "body", config, getLogger("testLogger"))
+        self.assertEqual(self.transport.sends, 2)
+
+    @patch("app.send_email")
+    async def test_authenticate_answers_503_while_open(self, mock_send_email):
+        breaker = self.app.config["EMAIL_CONFIG"].breaker
+        for _ in range(2):
+            breaker.record(breaker.allow_request(), False, 0)
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.post(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@inspection.gc.ca"},
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "60")
+        self.assertEqual(
+            (await response.get_json())["error"],
+            self.email_config.email_unavailable,
+        )
+        mock_send_email.assert_not_called()
+
+    @patch("app.send_email")
+    async def test_half_open_breaker_accepts_the_probe_request_only(
+        self, mock_send_email
+    ):
+        breaker = self.app.config["EMAIL_CONFIG"].breaker
+        for _ in range(2):
+            breaker.record(breaker.allow_request(), False, 0)
+        breaker.config.open_seconds = 0
+        self.assertEqual(breaker.state, HALF_OPEN)
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        statuses = [
+            (
+                await self.test_client.post(
+                    f"/authenticate?token={sample_jwt_token}",
+                    json={"email": "test@inspection.gc.ca"},
+                )
+            ).status_code
+            for _ in range(3)
+        ]
+        self.assertEqual(statuses, [200, 503, 503])
+        mock_send_email.assert_called_once()
+        # The background send is handed the route's admission.
+        self.assertIsNotNone(mock_send_email.call_args.args[4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Tests for configuration snapshots and hot reload.
+"""
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from quart import Quart
+
+from app_create import (
+    apply_config_snapshot,
+    load_config_snapshot,
+    load_dotenv_file,
+    reload_config,
+)
+from circuit_breaker import CLOSED, OPEN
+from emails import SMTPEmailTransport
+
+ENVIRONMENT = {
+    "MEMBRANE_CORS_ALLOWED_ORIGINS": "http://localhost:3000",
+    "MEMBRANE_FRONTEND": "http://localhost:3000",
+    "MEMBRANE_SECRET_KEY": "secret",
+    "MEMBRANE_CLIENT_PUBLIC_KEYS_DIRECTORY": "tests/client_public_keys",
+    "MEMBRANE_SERVER_PRIVATE_KEY": "tests/server_private_key/server_private_key.pem",
+    "MEMBRANE_SERVER_PUBLIC_KEY": "tests/server_public_key/server_public_key.pem",
+    "MEMBRANE_COMM_CONNECTION_STRING": (
+        "endpoint=https://example.communication.azure.com/;accesskey=c2VjcmV0"
+    ),
+    "MEMBRANE_SENDER_EMAIL": "DoNotReply@example.com",
+    "MEMBRANE_TOKEN_BLACKLIST": "revoked",
+    "MEMBRANE_LOGGING_LEVEL": "CRITICAL",
+}
+
+
+@patch("app_create.dotenv_values", return_value={})
+class TestConfigReload(unittest.TestCase):
+    def setUp(self):
+        self.environment = patch.dict(os.environ, ENVIRONMENT)
+        self.environment.start()
+        self.app = Quart(__name__)
+
+    def tearDown(self):
+        self.environment.stop()
+
+    def test_snapshot_is_read_only(self, mock_dotenv_values):
+        snapshot = load_config_snapshot(1)
+        self.assertIsNotNone(snapshot.values["JWT_CONFIG"].keys)
+        with self.assertRaises(TypeError):
+            snapshot.values["MEMBRANE_FRONTEND"] = "http://elsewhere"
+
+    def test_reload_swaps_in_new_version(self, mock_dotenv_values):
+        apply_config_snapshot(self.app, load_config_snapshot(1))
+        in_flight_jwt_config = self.app.config["JWT_CONFIG"]
+
+        os.environ["MEMBRANE_CORS_ALLOWED_ORIGINS"] = "https://a.ca,https://b.ca"
+        os.environ["MEMBRANE_ALLOWED_EMAIL_DOMAINS_PATTERN"] = "^.+@example\\.com$"
+        snapshot = reload_config(self.app)
+
+        self.assertEqual(snapshot.version, 2)
+        self.assertIs(self.app.config["MEMBRANE_CONFIG_SNAPSHOT"], snapshot)
+        self.assertEqual(
+            self.app.config["MEMBRANE_CORS_ALLOWED_ORIGINS"],
+            ["https://a.ca", "https://b.ca"],
+        )
+        self.assertTrue(
+            self.app.config["EMAIL_CONFIG"].validation_regex.match("a@example.com")
+        )
+        self.assertIsNot(self.app.config["JWT_CONFIG"], in_flight_jwt_config)
+
+    def test_reload_keeps_tokens_consumed_at_runtime(self, mock_dotenv_values):
+        apply_config_snapshot(self.app, load_config_snapshot(1))
+        self.app.config["JWT_CONFIG"].token_ledger.consume("consumed", time.time())
+
+        os.environ["MEMBRANE_TOKEN_BLACKLIST"] = "other"
+        reload_config(self.app)
+
+        self.assertEqual(self.app.config["JWT_CONFIG"].token_blacklist, {"other"})
+        self.assertIn("consumed", self.app.config["JWT_CONFIG"].token_ledger)
+
+    def test_reload_keeps_email_circuit_breaker_state(self, mock_dotenv_values):
+        apply_config_snapshot(self.app, load_config_snapshot(1))
+        breaker = self.app.config["EMAIL_CONFIG"].breaker
+        for _ in range(breaker.config.minimum_calls):
+            breaker.record(breaker.allow_request(), False, 0)
+
+        os.environ["MEMBRANE_EMAIL_CIRCUIT_OPEN_SECONDS"] = "5"
+        reload_config(self.app)
+        self.assertIs(self.app.config["EMAIL_CONFIG"].breaker, breaker)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.config.open_seconds, 5)
+
+        # A different transport gets a breaker of its own.
+        os.environ["MEMBRANE_EMAIL_TRANSPORT"] = "smtp"
+        os.environ["MEMBRANE_SMTP_HOST"] = "relay.example.com"
+        reload_config(self.app)
+        self.assertEqual(self.app.config["EMAIL_CONFIG"].breaker.state, CLOSED)
+
+    def test_failed_reload_keeps_current_snapshot(self, mock_dotenv_values):
+        snapshot = load_config_snapshot(1)
+        apply_config_snapshot(self.app, snapshot)
+
+        os.environ["MEMBRANE_SERVER_PUBLIC_KEY"] = "tests/missing.pem"
+        with self.assertRaises(ValueError):
+            reload_config(self.app)
+
+        self.assertIs(self.app.config["MEMBRANE_CONFIG_SNAPSHOT"], snapshot)
+
+    def test_smtp_transport_is_selected(self, mock_dotenv_values):
+        os.environ["MEMBRANE_EMAIL_TRANSPORT"] = "smtp"
+        os.environ["MEMBRANE_SMTP_HOST"] = "relay.example.com"
+        os.environ["MEMBRANE_SMTP_POOL_SIZE"] = "8"
+        transport = load_config_snapshot(1).values["EMAIL_CONFIG"].transport
+        self.assertIsInstance(transport, SMTPEmailTransport)
+        self.assertEqual(transport.hostname, "relay.example.com")
+        self.assertEqual(transport.pool_size, 8)
+
+        del os.environ["MEMBRANE_SMTP_HOST"]
+        with self.assertRaises(ValueError):
+            load_config_snapshot(1)
+
+
+@patch("app_create._dotenv_keys", new_callable=set)
+class TestDotenvReload(unittest.TestCase):
+    def setUp(self):
+        self.environment = patch.dict(
+            os.environ, {"MEMBRANE_FRONTEND": "https://deployment.ca"}
+        )
+        self.environment.start()
+        self.addCleanup(self.environment.stop)
+
+    def load(self, values):
+        with patch("app_create.dotenv_values", return_value=values):
+            load_dotenv_file()
+
+    def test_reload_keeps_startup_precedence(self, dotenv_keys):
+        self.load(
+            {"MEMBRANE_FRONTEND": "https://stale.ca", "MEMBRANE_SENDER_EMAIL": "a@b.ca"}
+        )
+        self.assertEqual(os.environ["MEMBRANE_FRONTEND"], "https://deployment.ca")
+        self.assertEqual(os.environ["MEMBRANE_SENDER_EMAIL"], "a@b.ca")
+
+        self.load(
+            {"MEMBRANE_FRONTEND": "https://stale.ca", "MEMBRANE_SENDER_EMAIL": "c@d.ca"}
+        )
+        self.assertEqual(os.environ["MEMBRANE_FRONTEND"], "https://deployment.ca")
+        self.assertEqual(os.environ["MEMBRANE_SENDER_EMAIL"], "c@d.ca")
+
+    def test_key_removed_from_dotenv_is_unset(self, dotenv_keys):
+        self.load({"MEMBRANE_SENDER_EMAIL": "a@b.ca"})
+        self.load({})
+        self.assertNotIn("MEMBRANE_SENDER_EMAIL", os.environ)
+        self.assertEqual(os.environ["MEMBRANE_FRONTEND"], "https://deployment.ca")
@@ -0,0 +1,118 @@
+"""
+Tests for the compiled CORS policy and middleware.
+"""
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from quart import Quart
+
+from cors import CorsConfigError, compile_cors_policy, register_cors
+
+
+class TestCorsPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = compile_cors_policy(
+            ["http://localhost:3000", "https://*.inspection.gc.ca"]
+        )
+
+    def test_exact_origin_is_allowed(self):
+        self.assertTrue(self.policy.is_allowed(b"http://localhost:3000"))
+        self.assertFalse(self.policy.is_allowed(b"http://localhost:4000"))
+
+    def test_wildcard_origin_matches_subdomains_only(self):
+        self.assertTrue(self.policy.is_allowed(b"https://app.inspection.gc.ca"))
+        self.assertTrue(self.policy.is_allowed(b"https://a.b.inspection.gc.ca"))
+        self.assertFalse(self.policy.is_allowed(b"https://inspection.gc.ca"))
+        self.assertFalse(self.policy.is_allowed(b"http://app.inspection.gc.ca"))
+        self.assertFalse(self.policy.is_allowed(b"https://evilinspection.gc.ca"))
+        self.assertFalse(self.policy.is_allowed(b"https://evil.com/.inspection.gc.ca"))
+
+    def test_header_blocks_are_prebuilt_and_reused(self):
+        blocks = self.policy.header_blocks(b"http://localhost:3000")
+        self.assertIs(blocks, self.policy.header_blocks(b"http://localhost:3000"))
+        self.assertIn(
+            (b"access-control-allow-origin", b"http://localhost:3000"), blocks[0]
+        )
+        self.assertIn((b"access-control-max-age", b"600"), blocks[1])
+
+    def test_any_origin_is_refused_with_credentials(self):
+        with self.assertRaises(CorsConfigError):
+            compile_cors_policy(["*"])
+        policy = compile_cors_policy(["*"], allow_credentials=False)
+        self.assertEqual(
+            dict(policy.header_blocks(b"https://elsewhere.example")[0]),
+            {
+                b"access-control-allow-origin": b"https://elsewhere.example",
+                b"vary": b"Origin",
+            },
+        )
+
+    def test_invalid_wildcard_origin_is_rejected(self):
+        with self.assertRaises(CorsConfigError):
+            compile_cors_policy(["https://app.*.ca"])
+
+
+class TestCorsMiddleware(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = Quart(__name__)
+        self.app.config["CORS_POLICY"] = compile_cors_policy(
+            ["http://localhost:3000"], max_age_seconds=120
+        )
+        self.route_calls = 0
+
+        @self.app.route("/authenticate", methods=["GET", "POST"])
+        async def authenticate():
+            self.route_calls += 1
+            return "ok"
+
+        register_cors(self.app)
+        self.client = self.app.test_client()
+
+    async def test_preflight_is_answered_without_reaching_the_app(self):
+        response = await self.client.options(
+            "/authenticate",
+            headers={
+                "Origin": "http://localhost:3000",
+                "Access-Control-Request-Method": "POST",
+                "Access-Control-Request-Headers": "content-type",
+            },
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            response.headers["Access-Control-Allow-Origin"], "http://localhost:3000"
+        )
+        self.assertEqual(response.headers["Access-Control-Max-Age"], "120")
+        self.assertEqual(
+            response.headers["Access-Control-Allow-Headers"], "content-type"
+        )
+        self.assertEqual(self.route_calls, 0)
+
+    async def test_preflight_from_disallowed_origin_gets_no_grant(self):
+        response = await self.client.options(
+            "/authenticate",
+            headers={
+                "Origin": "http://evil.example.com",
+                "Access-Control-Request-Method": "POST",
+            },
+        )
+        self.assertNotIn("Access-Control-Allow-Origin", response.headers)
+
+    async def test_actual_response_carries_cors_headers(self):
+        response = await self.client.post(
+            "/authenticate", headers={"Origin": "http://localhost:3000"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.headers["Access-Control-Allow-Origin"], "http://localhost:3000"
+        )
+        self.assertEqual(response.headers["Access-Control-Allow-Credentials"], "true")
+        self.assertEqual(response.headers["Vary"], "Origin")
+
+    async def test_policy_follows_configuration_reload(self):
+        self.app.config["CORS_POLICY"] = compile_cors_policy(["https://new.ca"])
+        response = await self.client.post(
+            "/authenticate", headers={"Origin": "https://new.ca"}
+        )
+        self.assertEqual(
+            response.headers["Access-Control-Allow-Origin"], "https://new.ca"
+        )
@@ -2,10 +2,16 @@
 Tests for JWT Token Decoding Operations.
 """
 import unittest
+from dataclasses import replace
 
 from conftest import TestConfig
 
-from jwt_utils import JWTError, JWTPublicKeyNotFoundError, decode_client_jwt_token
+from jwt_utils import (
+    JWTError,
+    JWTPublicKeyNotFoundError,
+    decode_client_jwt_token,
+    load_key_registry,
+)
 
 
 class TestJWTDecoding(TestConfig, unittest.TestCase):
@@ -39,3 +45,19 @@ class TestJWTDecoding(TestConfig, unittest.TestCase):
         jwt_token = ".".join(jwt_parts)
         with self.assertRaises(Exception):
             decode_client_jwt_token(jwt_token, self.jwt_config)
+
+    def test_decode_jwt_with_preloaded_keys(self):
+        jwt_config = replace(self.jwt_config, keys=load_key_registry(self.jwt_config))
+        self.assertEqual(
+            set(jwt_config.keys.client_public_keys), {"testapp1", "testapp2"}
+        )
+        jwt_token = self.generate_jwt_token(self.payload, jwt_config, "testapp1")
+        decoded_token = decode_client_jwt_token(jwt_token, jwt_config)
+        self.assertEqual(decoded_token[jwt_config.app_id_field], "testapp1")
+
+    def test_decode_jwt_with_preloaded_keys_and_nonexistent_app_id(self):
+        jwt_config = replace(self.jwt_config, keys=load_key_registry(self.jwt_config))
+        self.payload.update({jwt_config.app_id_field: "nonexistent"})
+        jwt_token = self.generate_jwt_token(self.payload, jwt_config, "testapp1")
+        with self.assertRaises(JWTPublicKeyNotFoundError):
+            decode_client_jwt_token(jwt_token, jwt_config)
@@ -1,19 +1,35 @@
+import asyncio
+import socket
 import unittest
+from dataclasses import replace
 from logging import getLogger
+from unittest import IsolatedAsyncioTestCase
 from unittest.mock import MagicMock, patch
 
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
 from conftest import TestConfig
 
 from emails import (
+    AzureEmailTransport,
     EmailSendingFailedError,
     EmailsException,
     PollingTimeoutError,
+    SMTPEmailTransport,
     send_email,
 )
 
 
-class TestEmailSending(TestConfig, unittest.TestCase):
-    def test_send_email_success(self):
+class TestEmailSending(TestConfig, IsolatedAsyncioTestCase):
+    def azure_config(self, email_client):
+        return replace(
+            self.email_config,
+            transport=AzureEmailTransport(
+                email_client, poller_wait_seconds=2, timeout=20
+            ),
+        )
+
+    async def test_send_email_success(self):
         logger = getLogger("testLogger")
         mock_result = {"status": "Succeeded", "id": "some_id"}
 
@@ -22,22 +38,21 @@ class TestEmailSending(TestConfig, unittest.TestCase):
             mock_poller = MagicMock()
             mock_poller.result.return_value = mock_result
             mock_instance.begin_send.return_value = mock_poller
-            self.email_config.email_client = mock_instance
             email = {
                 "recipient_email": "recipient_email",
                 "body": "body",
-                "config": self.email_config,
+                "config": self.azure_config(mock_instance),
             }
 
             try:
-                result = send_email(**email, logger=logger)
+                result = await send_email(**email, logger=logger)
                 self.assertEqual(
                     result, {"status": "Succeeded", "operation_id": "some_id"}
                 )
             except EmailsException:
                 self.fail(f"Expected {email} to be successfully sent but was not.")
 
-    def test_send_email_fail(self):
+    async def test_send_email_fail(self):
         logger = getLogger("testLogger")
         mock_result = {"status": "Failed", "error": "some_error"}
 
@@ -46,17 +61,16 @@ class TestEmailSending(TestConfig, unittest.TestCase):
             mock_poller = MagicMock()
             mock_poller.result.return_value = mock_result
             mock_instance.begin_send.return_value = mock_poller
-            self.email_config.email_client = mock_instance
             email = {
                 "recipient_email": "recipient_email",
                 "body": "body",
-                "config": self.email_config,
+                "config": self.azure_config(mock_instance),
             }
 
             with self.assertRaises(EmailSendingFailedError):
-                send_email(**email, logger=logger)
+                await send_email(**email, logger=logger)
 
-    def test_polling_timeout_error(self):
+    async def test_polling_timeout_error(self):
         logger = getLogger("testLogger")
 
         with patch("azure.communication.email.EmailClient") as MockEmailClient:
@@ -65,12 +79,142 @@ class TestEmailSending(TestConfig, unittest.TestCase):
             mock_poller.done.return_value = False
             mock_instance.begin_send.return_value = mock_poller
 
-            self.email_config.email_client = mock_instance
             email = {
                 "recipient_email": "recipient_email",
                 "body": "body",
-                "config": self.email_config,
+                "config": self.azure_config(mock_instance),
             }
 
             with self.assertRaises(PollingTimeoutError):
-                send_email(**email, logger=logger)
+                await send_email(**email, logger=logger)
+
+
+class RecordingHandler:
+    """aiosmtpd handler recording each message and the session that carried it."""
+
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+        self.logins = 0
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        self.logins += 1
+        return AuthResult(
+            success=(auth_data.login, auth_data.password) == (b"membrane", b"secret")
+        )
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("refused@"):
+            return "550 Mailbox unavailable"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.sessions.add(id(session))
+        return "250 Message accepted for delivery"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestSMTPEmailTransport(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.handler = RecordingHandler()
+        self.controller = Controller(
+            self.handler,
+            hostname="127.0.0.1",
+            port=free_port(),
+            authenticator=self.handler.authenticate,
+            auth_require_tls=False,
+        )
+        self.controller.start()
+        self.addCleanup(self.controller.stop)
+
+    def smtp_config(self, **options):
+        self.transport = SMTPEmailTransport(
+            hostname="127.0.0.1",
+            port=self.controller.port,
+            username="membrane",
+            password="secret",
+            security="none",
+            timeout=5,
+            **options,
+        )
+        return replace(
+            self.email_config, transport=self.transport, sender_email="membrane@gc.ca"
+        )
+
+    async def send(self, config, recipient="test@inspection.gc.ca"):
+        return await send_email(recipient, "body", config, getLogger("testLogger"))
+
+    async def asyncTearDown(self):
+        await self.transport.close()
+
+    async def test_messages_share_one_authenticated_connection(self):
+        config = self.smtp_config()
+        for _ in range(3):
+            result = await self.send(config)
+            self.assertEqual(result["status"], "Succeeded")
+
+        self.assertEqual(len(self.handler.messages), 3)
+        self.assertEqual(len(self.handler.sessions), 1)
+        self.assertEqual(self.handler.logins, 1)
+        envelope = self.handler.messages[0]
+        self.assertEqual(envelope.mail_from, "membrane@gc.ca")
+        self.assertEqual(envelope.rcpt_tos, ["test@inspection.gc.ca"])
+        self.assertIn(result["operation_id"].encode(), self.handler.messages[2].content)
+
+    async def test_connection_is_replaced_after_max_messages(self):
+        config = self.smtp_config(max_messages_per_connection=2)
+        for _ in range(5):
+            await self.send(config)
+        self.assertEqual(len(self.handler.sessions), 3)
+
+    async def test_concurrent_sends_are_bounded_by_pool_size(self):
+        config = self.smtp_config(pool_size=2)
+        await asyncio.gather(*(self.send(config) for _ in range(8)))
+        self.assertEqual(len(self.handler.messages), 8)
+        self.assertLessEqual(len(self.handler.sessions), 2)
+
+    async def test_dropped_idle_connection_is_replaced(self):
+        config = self.smtp_config()
+        await self.send(config)
+        self.transport._idle[0].client.close()
+        await self.send(config)
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(len(self.handler.sessions), 2)
+
+    async def test_closed_transport_still_sends_without_pooling(self):
+        config = self.smtp_config()
+        await self.send(config)
+        await self.transport.close()
+        for _ in range(2):
+            result = await self.send(config)
+            self.assertEqual(result["status"], "Succeeded")
+        self.assertEqual(len(self.handler.messages), 3)
+        self.assertEqual(len(self.handler.sessions), 3)
+        self.assertEqual(self.transport._idle, [])
+
+    async def test_refused_recipient_keeps_connection(self):
+        config = self.smtp_config()
+        with self.assertRaises(EmailSendingFailedError):
+            await self.send(config, recipient="refused@inspection.gc.ca")
+        await self.send(config)
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertEqual(self.handler.logins, 1)
+
+    async def test_failed_login_raises(self):
+        config = self.smtp_config()
+        self.transport.password = "wrong"
+        with self.assertRaises(EmailSendingFailedError):
+            await self.send(config)
+        self.assertEqual(self.handler.messages, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
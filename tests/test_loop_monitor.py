@@ -0,0 +1,78 @@
+"""
+Tests for the event loop lag monitor.
+"""
+import asyncio
+import logging
+import time
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, patch
+
+from conftest import TestConfig
+
+import metrics
+from loop_monitor import LoopMonitor, LoopMonitorConfig
+
+
+def blocking_call(seconds):
+    time.sleep(seconds)
+
+
+class TestLoopMonitor(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        metrics.reset()
+        # Other tests disable logging; the stall reports are what is tested here.
+        self.addCleanup(logging.disable, logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+        self.logger = logging.getLogger("test_loop_monitor")
+        self.monitor = LoopMonitor(
+            LoopMonitorConfig(interval_seconds=0.01, stall_threshold_seconds=0.1),
+            self.logger,
+        )
+        self.monitor.start()
+
+    async def asyncTearDown(self):
+        await self.monitor.stop()
+
+    async def test_lag_is_published(self):
+        await asyncio.sleep(0.05)
+        blocking_call(0.05)
+        await asyncio.sleep(0.05)
+
+        self.assertGreaterEqual(self.monitor.max_lag(), 0.04)
+        self.assertLess(self.monitor.lag_quantile(0.5), 0.04)
+        gauges = metrics.snapshot()["gauges"]
+        self.assertEqual(
+            gauges["membrane_loop_lag_max_seconds"], self.monitor.max_lag()
+        )
+        self.assertIn('membrane_loop_lag_seconds{quantile="0.99"}', gauges)
+
+    async def test_stall_is_logged_with_blocking_stack(self):
+        await asyncio.sleep(0.05)
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            blocking_call(0.4)
+            await asyncio.sleep(0.05)
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("blocking_call", logs.output[0])
+        self.assertIn("test_loop_monitor.py", logs.output[0])
+        self.assertEqual(metrics.counter_value("membrane_loop_stalls_total"), 1)
+
+    async def test_stop_unregisters_gauges(self):
+        await self.monitor.stop()
+        self.assertEqual(metrics.snapshot()["gauges"], {})
+        self.monitor.start()
+
+
+class TestRequestLogging(TestConfig, IsolatedAsyncioTestCase):
+    async def test_body_is_not_read_unless_debug_logging(self):
+        with patch(
+            "quart.wrappers.Request.get_data", new_callable=AsyncMock
+        ) as get_data:
+            response = await self.test_client.get("/authenticate")
+        self.assertEqual(response.status_code, 405)
+        get_data.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+Tests for the structural token check run ahead of JWT decoding.
+"""
+import base64
+import json
+import logging
+import unittest
+from dataclasses import replace
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from conftest import TestConfig
+
+import metrics
+from jwt_utils import (
+    TOKEN_BAD_ALGORITHM,
+    TOKEN_BAD_ALPHABET,
+    TOKEN_BAD_HEADER,
+    TOKEN_BAD_SEGMENT_COUNT,
+    TOKEN_BAD_TYPE,
+    TOKEN_MISSING,
+    TOKEN_TOO_LONG,
+    precheck_token,
+)
+
+DEEPLY_NESTED = base64.urlsafe_b64encode(b"[" * 2500).rstrip(b"=").decode()
+
+
+def encode_segment(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b"=").decode()
+
+
+class TestPrecheckToken(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def token_with_header(self, header):
+        return f"{encode_segment(header)}.{encode_segment(self.payload)}.c2ln"
+
+    def test_well_formed_token_returns_header(self):
+        jwt_token = self.generate_jwt_token(self.payload, self.jwt_config, "testapp1")
+        header, rejection = precheck_token(jwt_token, self.jwt_config)
+        self.assertIsNone(rejection)
+        self.assertEqual(header["alg"], self.jwt_config.algorithm)
+        self.assertEqual(header[self.jwt_config.app_id_field], "testapp1")
+
+    def test_rejection_reasons(self):
+        jwt_token = self.generate_jwt_token(self.payload, self.jwt_config, "testapp1")
+        cases = {
+            None: TOKEN_MISSING,
+            "": TOKEN_MISSING,
+            "a" * (self.jwt_config.max_token_length + 1): TOKEN_TOO_LONG,
+            "invalid.jwt": TOKEN_BAD_SEGMENT_COUNT,
+            jwt_token + ".extra": TOKEN_BAD_SEGMENT_COUNT,
+            jwt_token.replace(".", "..", 1)[:-1]: TOKEN_BAD_SEGMENT_COUNT,
+            "abc.d+f.ghi": TOKEN_BAD_ALPHABET,
+            "abc.def.": TOKEN_BAD_ALPHABET,
+            "invalid.jwt.token": TOKEN_BAD_HEADER,
+            f"{encode_segment([1])}.e30.c2ln": TOKEN_BAD_HEADER,
+            f"{DEEPLY_NESTED}.e30.c2ln": TOKEN_BAD_HEADER,
+            self.token_with_header({"alg": "RS256", "x": "a" * 1024}): TOKEN_BAD_HEADER,
+            self.token_with_header({"alg": "none"}): TOKEN_BAD_ALGORITHM,
+            self.token_with_header({"typ": "JWT"}): TOKEN_BAD_ALGORITHM,
+            self.token_with_header({"alg": "RS256", "typ": "JWE"}): TOKEN_BAD_TYPE,
+        }
+        for jwt_token, reason in cases.items():
+            with self.subTest(token=jwt_token and jwt_token[:40]):
+                self.assertEqual(
+                    precheck_token(jwt_token, self.jwt_config), (None, reason)
+                )
+
+    def test_nested_header_within_the_length_cap_is_rejected(self):
+        nested_header = (
+            base64.urlsafe_b64encode(b'{"a":' + b"[" * 760).rstrip(b"=").decode()
+        )
+        with patch("jwt_utils.json.loads", side_effect=RecursionError) as loads:
+            self.assertEqual(
+                precheck_token(f"{nested_header}.e30.c2ln", self.jwt_config),
+                (None, TOKEN_BAD_HEADER),
+            )
+        loads.assert_called_once()
+
+    async def test_deeply_nested_header_is_not_a_server_error(self):
+        response = await self.test_client.get(
+            f"/authenticate?token={DEEPLY_NESTED}.e30.c2ln"
+        )
+        self.assertEqual(response.status_code, 405)
+
+    async def test_invalid_token_is_logged_without_traceback(self):
+        # Other tests disable logging; the log line is what is tested here.
+        self.addCleanup(logging.disable, logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+        self.payload.update({self.jwt_config.app_id_field: "unknown"})
+        jwt_token = self.generate_jwt_token(self.payload, self.jwt_config, "unknown")
+        with self.assertLogs(self.app.logger, logging.DEBUG) as logs:
+            response = await self.test_client.get(f"/authenticate?token={jwt_token}")
+        self.assertEqual(response.status_code, 405)
+        invalid = [r for r in logs.records if r.getMessage().startswith("Invalid")]
+        self.assertEqual(len(invalid), 1)
+        self.assertIsNone(invalid[0].exc_info)
+
+    def test_header_without_type_is_accepted(self):
+        header, rejection = precheck_token(
+            self.token_with_header({"alg": "RS256"}), self.jwt_config
+        )
+        self.assertIsNone(rejection)
+        self.assertNotIn("typ", header)
+
+    def test_max_length_is_configurable(self):
+        jwt_token = self.generate_jwt_token(self.payload, self.jwt_config, "testapp1")
+        jwt_config = replace(self.jwt_config, max_token_length=len(jwt_token) - 1)
+        self.assertEqual(precheck_token(jwt_token, jwt_config), (None, TOKEN_TOO_LONG))
+
+    async def test_authenticate_counts_rejections_without_decoding(self):
+        with patch("app.decode_client_jwt_token") as decode_client_jwt_token:
+            for jwt_token in ("invalid.jwt", "invalid.jwt", "abc.d+f.ghi"):
+                response = await self.test_client.get(
+                    f"/authenticate?token={jwt_token}"
+                )
+                self.assertEqual(response.status_code, 405)
+        decode_client_jwt_token.assert_not_called()
+        self.assertEqual(
+            metrics.counter_value(
+                "membrane_token_rejected_total", reason=TOKEN_BAD_SEGMENT_COUNT
+            ),
+            2,
+        )
+        self.assertEqual(
+            metrics.counter_value(
+                "membrane_token_rejected_total", reason=TOKEN_BAD_ALPHABET
+            ),
+            1,
+        )
+
+    async def test_admin_metrics_report_rejections(self):
+        self.app.config["MEMBRANE_ADMIN_TOKEN"] = "secret"
+        self.addCleanup(self.app.config.pop, "MEMBRANE_ADMIN_TOKEN")
+        await self.test_client.get("/authenticate")
+        response = await self.test_client.get(
+            "/admin/metrics", headers={"Authorization": "Bearer secret"}
+        )
+        self.assertEqual(response.status_code, 200)
+        report = await response.get_json()
+        self.assertEqual(
+            report["counters"],
+            {f'membrane_token_rejected_total{{reason="{TOKEN_MISSING}"}}': 1},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
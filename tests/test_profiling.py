@@ -0,0 +1,100 @@
+"""
+Tests for the on-demand profiling hooks and their admin guard.
+"""
+import tempfile
+import tracemalloc
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+
+from conftest import TestConfig
+
+from profiling import (
+    InvalidProfileDurationError,
+    Profiler,
+    ProfilerBusyError,
+    ProfilingConfig,
+)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.profiler = Profiler(
+            ProfilingConfig(output_directory=Path(self.directory.name))
+        )
+
+    def tearDown(self):
+        if tracemalloc.is_tracing():
+            self.profiler.stop_memory_tracing()
+        self.directory.cleanup()
+
+    def test_profile_cpu_writes_collapsed_stacks(self):
+        with ThreadPoolExecutor(1) as executor:
+            result = executor.submit(self.profiler.profile_cpu, 0.05).result()
+        self.assertGreater(result["samples"], 0)
+        lines = Path(result["path"]).read_text().splitlines()
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertIn("MainThread;", stack)
+        self.assertGreater(int(count), 0)
+
+    def test_profile_cpu_rejects_out_of_bounds_duration(self):
+        with self.assertRaises(InvalidProfileDurationError):
+            self.profiler.profile_cpu(self.profiler.config.max_seconds + 1)
+
+    def test_profile_cpu_rejects_concurrent_profiles(self):
+        self.profiler._cpu_lock.acquire()
+        try:
+            with self.assertRaises(ProfilerBusyError):
+                self.profiler.profile_cpu(0.01)
+        finally:
+            self.profiler._cpu_lock.release()
+
+    def test_memory_snapshot_reports_growth_since_previous(self):
+        self.profiler.snapshot_memory()
+        retained = [bytearray(1024) for _ in range(256)]
+        result = self.profiler.snapshot_memory()
+        self.assertTrue(Path(result["path"]).exists())
+        self.assertTrue(
+            any(
+                "test_profiling.py" in stat["location"]
+                and stat["size_diff_bytes"] >= 256 * 1024
+                for stat in result["top"]
+            )
+        )
+        self.assertTrue(retained)
+
+
+class TestProfilingEndpoints(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.app.config["PROFILER"] = Profiler(
+            ProfilingConfig(output_directory=Path(self.directory.name))
+        )
+        self.app.config["MEMBRANE_ADMIN_TOKEN"] = "admin-secret"
+
+    def tearDown(self):
+        self.app.config.pop("MEMBRANE_ADMIN_TOKEN")
+        self.directory.cleanup()
+
+    async def test_admin_routes_hidden_without_admin_token(self):
+        self.app.config["MEMBRANE_ADMIN_TOKEN"] = None
+        response = await self.test_client.post("/admin/profile/cpu?seconds=0.01")
+        self.assertEqual(response.status_code, 404)
+
+    async def test_admin_routes_reject_wrong_token(self):
+        response = await self.test_client.post(
+            "/admin/profile/cpu?seconds=0.01",
+            headers={"Authorization": "Bearer wrong"},
+        )
+        self.assertEqual(response.status_code, 401)
+
+    async def test_cpu_profile_endpoint(self):
+        response = await self.test_client.post(
+            "/admin/profile/cpu?seconds=0.05",
+            headers={"Authorization": "Bearer admin-secret"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue((await response.get_json())["path"].endswith(".folded"))
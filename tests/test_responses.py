@@ -0,0 +1,92 @@
+"""
+Tests for the JSON provider and the precomputed response bodies.
+"""
+import json
+import unittest
+from datetime import datetime, timezone
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from conftest import TestConfig
+from quart import Quart
+
+from responses import OrjsonProvider, build_response_bodies
+
+
+class TestOrjsonProvider(unittest.TestCase):
+    def setUp(self):
+        self.provider = OrjsonProvider(Quart(__name__))
+
+    def test_output_matches_the_default_provider(self):
+        value = {
+            "b": [1, 2.5, None, True],
+            "a": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        }
+        self.assertEqual(
+            self.provider.dumps(value),
+            json.dumps(
+                {"a": "Tue, 02 Jan 2024 03:04:05 GMT", "b": [1, 2.5, None, True]},
+                separators=(",", ":"),
+            ),
+        )
+
+    def test_values_orjson_rejects_fall_back_to_the_stdlib(self):
+        self.assertEqual(self.provider.dumps({"n": 2**70}), '{"n":%d}' % 2**70)
+
+    def test_loads(self):
+        self.assertEqual(
+            self.provider.loads(b'{"email":"a@b.ca"}'), {"email": "a@b.ca"}
+        )
+        with self.assertRaises(json.JSONDecodeError):
+            self.provider.loads(b"{")
+
+
+class TestPrecomputedResponses(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bodies = self.app.config["RESPONSE_BODIES"]
+
+    def test_bodies_are_what_jsonify_would_produce(self):
+        bodies = build_response_bodies("Sent", "Unavailable", "oops", "Try again")
+        self.assertEqual(bodies.email_sent, b'{"message":"Sent"}\n')
+        self.assertEqual(bodies.email_unavailable, b'{"error":"Unavailable"}\n')
+        self.assertEqual(
+            bodies.invalid_request, b'{"error":"Invalid request method"}\n'
+        )
+        self.assertEqual(bodies.generic_error, b'{"oops":"Try again"}\n')
+
+    @patch("app.send_verification_email")
+    async def test_email_submission_answers_with_the_precomputed_body(
+        self, mock_send_email
+    ):
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.post(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@inspection.gc.ca"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(await response.get_data(), self.bodies.email_sent)
+
+    async def test_invalid_token_answers_with_the_precomputed_body(self):
+        response = await self.test_client.get("/authenticate?token=not.a.token")
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(await response.get_data(), self.bodies.invalid_request)
+
+    async def test_unexpected_error_answers_with_the_precomputed_body(self):
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        with patch("app.validate_email_from_request", side_effect=RuntimeError):
+            response = await self.test_client.post(
+                f"/authenticate?token={sample_jwt_token}",
+                json={"email": "test@inspection.gc.ca"},
+            )
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(await response.get_data(), self.bodies.generic_error)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+Tests for the pre-fork serving entry point.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+from pathlib import Path
+from unittest.mock import patch
+
+from conftest import app
+
+from serve import (
+    SERVING_PROFILES,
+    build_hypercorn_config,
+    load_application,
+    read_cgroup_cpu_quota,
+    resolve_event_loop,
+    resolve_workers,
+)
+
+ROOT = Path(__file__).resolve().parent.parent
+STARTUP_TIMEOUT_SECONDS = 30
+
+
+class TestServeConfig(unittest.TestCase):
+    def test_hypercorn_config_from_environment(self):
+        environment = {
+            "PORT": "8080",
+            "MEMBRANE_WORKERS": "4",
+            "MEMBRANE_KEEP_ALIVE": "7",
+        }
+        with patch.dict(os.environ, environment):
+            config = build_hypercorn_config()
+        self.assertEqual(config.bind, [":8080"])
+        self.assertEqual(config.workers, 4)
+        self.assertEqual(config.keep_alive_timeout, 7)
+        self.assertEqual(config.application_path, "app:app")
+
+    def test_serving_profile_with_overrides(self):
+        environment = {
+            "MEMBRANE_WORKERS": "2",
+            "MEMBRANE_SERVING_PROFILE": "tuned",
+            "MEMBRANE_MAX_REQUESTS": "500",
+        }
+        with patch.dict(os.environ, environment):
+            os.environ.pop("MEMBRANE_KEEP_ALIVE", None)
+            config = build_hypercorn_config()
+        tuned = SERVING_PROFILES["tuned"]
+        self.assertEqual(config.backlog, tuned.backlog)
+        self.assertEqual(config.keep_alive_timeout, tuned.keep_alive_timeout)
+        self.assertEqual(config.graceful_timeout, tuned.graceful_timeout)
+        self.assertEqual(config.max_requests, 500)
+        self.assertEqual(
+            config.h2_max_concurrent_streams, tuned.h2_max_concurrent_streams
+        )
+
+    def test_unknown_serving_profile_is_rejected(self):
+        with patch.dict(os.environ, {"MEMBRANE_SERVING_PROFILE": "fastest"}):
+            with self.assertRaises(ValueError):
+                build_hypercorn_config()
+
+    def test_event_loop_selection(self):
+        with patch("serve.find_spec", return_value=None):
+            self.assertEqual(resolve_event_loop("auto"), "asyncio")
+            with self.assertRaises(ValueError):
+                resolve_event_loop("uvloop")
+        with patch("serve.find_spec", return_value=object()):
+            self.assertEqual(resolve_event_loop("auto"), "uvloop")
+            self.assertEqual(resolve_event_loop("asyncio"), "asyncio")
+        with self.assertRaises(ValueError):
+            resolve_event_loop("trio")
+
+
+class TestWorkerSizing(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cgroup_root = Path(directory.name)
+
+    def write(self, name, content):
+        path = self.cgroup_root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    def test_cgroup_v2_quota(self):
+        self.write("cpu.max", "150000 100000\n")
+        self.assertEqual(read_cgroup_cpu_quota(self.cgroup_root), 1.5)
+
+    def test_cgroup_v2_unlimited(self):
+        self.write("cpu.max", "max 100000\n")
+        self.assertIsNone(read_cgroup_cpu_quota(self.cgroup_root))
+
+    def test_cgroup_v1_quota(self):
+        self.write("cpu,cpuacct/cpu.cfs_quota_us", "200000\n")
+        self.write("cpu,cpuacct/cpu.cfs_period_us", "100000\n")
+        self.assertEqual(read_cgroup_cpu_quota(self.cgroup_root), 2)
+
+    def test_cgroup_v1_unlimited(self):
+        self.write("cpu/cpu.cfs_quota_us", "-1\n")
+        self.write("cpu/cpu.cfs_period_us", "100000\n")
+        self.assertIsNone(read_cgroup_cpu_quota(self.cgroup_root))
+
+    def test_auto_workers_follow_quota(self):
+        self.write("cpu.max", "150000 100000\n")
+        with patch("serve.os.sched_getaffinity", return_value=set(range(8))):
+            self.assertEqual(resolve_workers("auto", self.cgroup_root), 2)
+            self.assertEqual(resolve_workers("3", self.cgroup_root), 3)
+
+    def test_auto_workers_without_quota_use_cpus(self):
+        with patch("serve.os.sched_getaffinity", return_value=set(range(8))):
+            self.assertEqual(resolve_workers("auto", self.cgroup_root), 8)
+
+    def test_load_application_reuses_imported_module(self):
+        self.assertIs(load_application("app:app"), app)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "fork() is unavailable")
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.profile_directory = Path(directory.name) / "profiles"
+        self.environment = {
+            **os.environ,
+            "PORT": str(self.port),
+            "MEMBRANE_WORKERS": "1",
+            "MEMBRANE_HEALTH_MESSAGE": "ok",
+            "MEMBRANE_CORS_ALLOWED_ORIGINS": "http://localhost:3000",
+            "MEMBRANE_FRONTEND": "http://localhost:3000",
+            "MEMBRANE_SECRET_KEY": "secret",
+            "MEMBRANE_CLIENT_PUBLIC_KEYS_DIRECTORY": "tests/client_public_keys",
+            "MEMBRANE_SERVER_PRIVATE_KEY": (
+                "tests/server_private_key/server_private_key.pem"
+            ),
+            "MEMBRANE_SERVER_PUBLIC_KEY": "tests/server_public_key/server_public_key.pem",
+            "MEMBRANE_COMM_CONNECTION_STRING": (
+                "endpoint=https://example.communication.azure.com/;accesskey=c2VjcmV0"
+            ),
+            "MEMBRANE_SENDER_EMAIL": "noreply@example.com",
+            "MEMBRANE_AUDIT_FILE": str(Path(directory.name) / "audit.jsonl"),
+            "MEMBRANE_PROFILE_DIRECTORY": str(self.profile_directory),
+        }
+
+    def get_health(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+        while True:
+            try:
+                with urllib.request.urlopen(
+                    f"http://127.0.0.1:{self.port}/health", timeout=1
+                ) as response:
+                    return response.status, response.read()
+            except (urllib.error.URLError, ConnectionError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def start_server(self):
+        server = subprocess.Popen(
+            [sys.executable, "serve.py"],
+            cwd=ROOT,
+            env=self.environment,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.addCleanup(server.kill)
+        self.assertEqual(self.get_health(), (200, b"ok"))
+        return server
+
+    def test_forked_worker_serves_requests(self):
+        server = self.start_server()
+        server.send_signal(signal.SIGTERM)
+        self.assertEqual(server.wait(timeout=STARTUP_TIMEOUT_SECONDS), 0)
+
+    @unittest.skipUnless(hasattr(signal, "SIGUSR2"), "SIGUSR2 is unavailable")
+    def test_profiling_signal_is_forwarded_to_the_workers(self):
+        server = self.start_server()
+        server.send_signal(signal.SIGUSR2)
+        deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+        while not list(self.profile_directory.glob("*.tracemalloc")):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.1)
+        self.assertIsNone(server.poll())
+        self.assertEqual(self.get_health(), (200, b"ok"))
+        server.send_signal(signal.SIGTERM)
+        self.assertEqual(server.wait(timeout=STARTUP_TIMEOUT_SECONDS), 0)
@@ -0,0 +1,125 @@
+"""
+Tests for the server-side session backends and the reuse of verified sessions.
+"""
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from conftest import TestConfig
+from quart import Quart
+
+import jwt_utils
+from jwt_utils import TokenLedger
+from session_store import (
+    MembraneSession,
+    MemorySessionInterface,
+    SQLiteSessionInterface,
+)
+
+
+class TestMemorySessionInterface(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.interface = MemorySessionInterface(max_entries=2, key_prefix="session:")
+
+    async def test_least_recently_used_session_is_evicted(self):
+        await self.interface.set("a", "1", expiry=60)
+        await self.interface.set("b", "2", expiry=60)
+        await self.interface.get("a")
+        await self.interface.set("c", "3", expiry=60)
+        self.assertEqual(await self.interface.get("a"), "1")
+        self.assertIsNone(await self.interface.get("b"))
+        self.assertEqual(len(self.interface), 2)
+
+    async def test_expired_session_is_forgotten(self):
+        with patch("session_store.time.monotonic", return_value=1000):
+            await self.interface.set("a", "1", expiry=60)
+        with patch("session_store.time.monotonic", return_value=1061):
+            self.assertIsNone(await self.interface.get("a"))
+        self.assertEqual(len(self.interface), 0)
+
+
+class TestSQLiteSessionInterface(IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "sessions.sqlite3"
+
+    async def test_sessions_are_shared_through_the_file(self):
+        first = SQLiteSessionInterface(path=self.path, key_prefix="session:")
+        second = SQLiteSessionInterface(path=self.path, key_prefix="session:")
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        await first.set("a", "1", expiry=60)
+        self.assertEqual(await second.get("a"), "1")
+        await second.delete("a")
+        self.assertIsNone(await first.get("a"))
+
+    async def test_expired_session_is_not_returned(self):
+        interface = SQLiteSessionInterface(path=self.path, key_prefix="session:")
+        self.addCleanup(interface.close)
+        await interface.set("a", "1", expiry=-1)
+        self.assertIsNone(await interface.get("a"))
+
+    def test_backend_is_selected_from_the_config(self):
+        app = Quart(__name__)
+        app.config.update(SESSION_TYPE="sqlite", SESSION_SQLITE_FILE=str(self.path))
+        MembraneSession(app)
+        self.assertIsInstance(app.session_interface, SQLiteSessionInterface)
+        self.assertEqual(app.session_interface.path, self.path)
+
+
+class TestVerifiedSessionReuse(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        # A fresh ledger so that tokens minted in the same second by other tests
+        # do not count as used.
+        self.app.config["JWT_CONFIG"] = replace(
+            self.jwt_config, token_ledger=TokenLedger(), token_blacklist=set()
+        )
+
+    async def authenticate_client(self):
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.get(f"/authenticate?token={sample_jwt_token}")
+        self.assertEqual(response.status_code, 302)
+        return urlparse(response.headers["Location"])
+
+    async def test_verified_session_skips_the_email(self):
+        self.assertEqual(
+            (await self.authenticate_client()).path, "membrane-frontend.ca"
+        )
+
+        response = await self.test_client.get(await self.sample_verification_token())
+        self.assertEqual(response.status_code, 302)
+
+        location = await self.authenticate_client()
+        self.assertEqual(location.path, "www.example.com")
+        token = parse_qs(location.query)["token"][0]
+        self.assertEqual(
+            jwt.get_unverified_header(token)["kid"],
+            jwt_utils.VERIFICATION_TOKEN_KEY_ID,
+        )
+        decoded_token = jwt_utils.verify_email_verification_token(
+            token, self.jwt_config
+        )
+        self.assertEqual(decoded_token["sub"], "test@inspection.gc.ca")
+        self.assertEqual(decoded_token[jwt_utils.VERIFICATION_APP_ID_CLAIM], "testapp1")
+
+    async def test_reused_link_does_not_start_a_session(self):
+        verification_url = await self.sample_verification_token()
+        token = parse_qs(urlparse(verification_url).query)["token"][0]
+        self.app.config["JWT_CONFIG"].token_blacklist = {token}
+        await self.test_client.get(verification_url)
+        self.assertEqual(
+            (await self.authenticate_client()).path, "membrane-frontend.ca"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
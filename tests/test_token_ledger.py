@@ -0,0 +1,95 @@
+"""
+Tests for single-use verification links.
+"""
+import time
+import unittest
+from dataclasses import replace
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+from conftest import TestConfig
+
+import jwt_utils
+from jwt_utils import (
+    TOKEN_LEDGER_EXPIRY_GRACE_SECONDS,
+    TokenLedger,
+    consume_email_verification_token,
+)
+
+
+class TestTokenLedger(unittest.TestCase):
+    def test_consume_reports_first_use_only(self):
+        ledger = TokenLedger()
+        expires_at = time.time() + 300
+        self.assertTrue(ledger.consume("token", expires_at))
+        self.assertFalse(ledger.consume("token", expires_at))
+        self.assertIn("token", ledger)
+
+    def test_expired_tokens_are_forgotten(self):
+        ledger = TokenLedger()
+        ledger.consume("old", time.time() - TOKEN_LEDGER_EXPIRY_GRACE_SECONDS - 1)
+        self.assertIn("old", ledger)
+        ledger.consume("recent", time.time() - 1)
+        ledger.consume("new", time.time() + 300)
+        self.assertNotIn("old", ledger)
+        self.assertIn("recent", ledger)
+        self.assertEqual(len(ledger), 2)
+
+
+class TestVerificationLinkClicks(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        # A fresh ledger so that tokens minted in the same second by other tests
+        # do not count as used.
+        self.app.config["JWT_CONFIG"] = replace(
+            self.jwt_config, token_ledger=TokenLedger()
+        )
+
+    async def click(self, verification_url):
+        with patch(
+            "jwt_utils.verify_email_verification_token",
+            wraps=jwt_utils.verify_email_verification_token,
+        ) as verify:
+            response = await self.test_client.get(verification_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(verify.call_count, 1)
+        return urlparse(response.headers["Location"])
+
+    async def test_second_click_redirects_without_token(self):
+        verification_url = await self.sample_verification_token()
+        token = parse_qs(urlparse(verification_url).query)["token"][0]
+
+        first = await self.click(verification_url)
+        self.assertEqual(parse_qs(first.query)["token"], [token])
+
+        second = await self.click(verification_url)
+        self.assertEqual(second.geturl(), "https://www.example.com/")
+
+        decoded_token, fresh = consume_email_verification_token(
+            token, self.app.config["JWT_CONFIG"]
+        )
+        self.assertEqual(decoded_token["sub"], "test@inspection.gc.ca")
+        self.assertFalse(fresh)
+
+    async def test_consume_reports_first_use_only(self):
+        verification_url = await self.sample_verification_token()
+        token = parse_qs(urlparse(verification_url).query)["token"][0]
+        jwt_config = self.app.config["JWT_CONFIG"]
+
+        self.assertTrue(consume_email_verification_token(token, jwt_config)[1])
+        self.assertFalse(consume_email_verification_token(token, jwt_config)[1])
+        with self.assertRaises(jwt_utils.JWTError):
+            consume_email_verification_token(None, jwt_config)
+
+    async def test_blacklisted_token_counts_as_used(self):
+        verification_url = await self.sample_verification_token()
+        token = parse_qs(urlparse(verification_url).query)["token"][0]
+        self.app.config["JWT_CONFIG"].token_blacklist = {token}
+
+        location = await self.click(verification_url)
+        self.assertEqual(location.geturl(), "https://www.example.com/")
+
+
+if __name__ == "__main__":
+    unittest.main()
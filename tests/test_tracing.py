@@ -0,0 +1,140 @@
+"""
+Tests for request and background task tracing.
+"""
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from conftest import TestConfig
+
+import tracing
+
+
+class ListSpanExporter(tracing.SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class TestTracing(TestConfig, IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.exporter = ListSpanExporter()
+        tracing.configure(
+            tracing.TracingConfig(sample_ratio=1.0, export_interval_seconds=0.01),
+            self.exporter,
+        )
+
+    def tearDown(self):
+        tracing.configure(tracing.TracingConfig())
+
+    def exported_spans(self):
+        tracing.shutdown()
+        return {span.name: span for span in self.exporter.spans}
+
+    def test_child_span_shares_trace_of_parent(self):
+        with tracing.span("parent") as parent:
+            with tracing.span("child", key="value") as child:
+                pass
+        spans = self.exported_spans()
+        self.assertEqual(child.trace_id, parent.trace_id)
+        self.assertEqual(spans["child"].parent_span_id, parent.context.span_id)
+        self.assertEqual(spans["child"].attributes, {"key": "value"})
+
+    def test_unsampled_trace_is_not_exported(self):
+        tracing.configure(tracing.TracingConfig(sample_ratio=0.0), self.exporter)
+        with tracing.span("parent"):
+            with tracing.span("child") as child:
+                self.assertFalse(child.recording)
+        self.assertEqual(self.exported_spans(), {})
+
+    def test_exception_is_recorded_on_span(self):
+        with self.assertRaises(ValueError):
+            with tracing.span("failing"):
+                raise ValueError("boom")
+        self.assertEqual(self.exported_spans()["failing"].error, "ValueError: boom")
+
+    def test_extract_traceparent(self):
+        context = tracing.extract(
+            "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+        )
+        self.assertEqual(context.trace_id, "4bf92f3577b34da6a3ce929d0e0e4736")
+        self.assertTrue(context.sampled)
+        self.assertEqual(
+            context.traceparent,
+            "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01",
+        )
+        self.assertIsNone(tracing.extract("not-a-traceparent"))
+
+    def test_remote_sampled_flag_is_not_trusted_by_default(self):
+        parent = tracing.extract(
+            "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+        )
+        tracing.configure(tracing.TracingConfig(sample_ratio=0.0), self.exporter)
+        span = tracing.start_span("request", parent=parent)
+        tracing.end_span(span)
+        self.assertFalse(span.recording)
+        self.assertEqual(span.trace_id, "4bf92f3577b34da6a3ce929d0e0e4736")
+        self.assertTrue(span.traceparent.endswith("-00"))
+
+        tracing.configure(
+            tracing.TracingConfig(sample_ratio=0.0, trust_traceparent=True),
+            self.exporter,
+        )
+        span = tracing.start_span("request", parent=parent)
+        tracing.end_span(span)
+        self.assertTrue(span.recording)
+        self.assertEqual(
+            self.exported_spans()["request"].parent_span_id, "00f067aa0ba902b7"
+        )
+
+    @patch("app.send_email")
+    async def test_background_email_task_joins_request_trace(self, mock_send_email):
+        traceparent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+        def fake_send_email(*args):
+            with tracing.span("email.send"):
+                pass
+
+        mock_send_email.side_effect = fake_send_email
+        sample_jwt_token = self.generate_jwt_token(
+            self.payload, self.jwt_config, "testapp1"
+        )
+        response = await self.test_client.post(
+            f"/authenticate?token={sample_jwt_token}",
+            json={"email": "test@inspection.gc.ca"},
+            headers={"traceparent": traceparent},
+        )
+        await asyncio.gather(*self.app.background_tasks)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "4bf92f3577b34da6a3ce929d0e0e4736", response.headers["traceparent"]
+        )
+        spans = self.exported_spans()
+        self.assertEqual(
+            spans["email.send"].trace_id, "4bf92f3577b34da6a3ce929d0e0e4736"
+        )
+        self.assertIn("jwt.decode_client_token", spans)
+        self.assertIn("jwt.client_key_lookup", spans)
+
+
+class TestFileSpanExporter(unittest.TestCase):
+    def test_writes_otlp_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "traces.jsonl"
+            exporter = tracing.FileSpanExporter(path, "membrane-test")
+            span = tracing.Span(
+                "span", tracing.SpanContext("a" * 32, "b" * 16, True), end_ns=1
+            )
+            exporter.export([span])
+            payload = json.loads(path.read_text())
+        resource_span = payload["resourceSpans"][0]
+        exported = resource_span["scopeSpans"][0]["spans"][0]
+        self.assertEqual(exported["traceId"], "a" * 32)
+        self.assertEqual(exported["name"], "span")
@@ -0,0 +1,430 @@
+"""
+Lightweight distributed tracing for requests and their background tasks.
+
+Spans are kept in a context variable, so work started from a request (including
+tasks scheduled with ``app.add_background_task``) is recorded under the request's
+trace. Finished spans are exported in batches, as OTLP/JSON, either to a local file
+or to an OTLP/HTTP collector.
+"""
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from inspect import iscoroutinefunction
+from pathlib import Path
+
+import requests
+
+from batching import BatchWorker
+
+DEFAULT_TRACING_EXPORTER = "none"
+DEFAULT_TRACING_SAMPLE_RATIO = 0.05
+DEFAULT_TRACING_FILE = "./traces.jsonl"
+DEFAULT_TRACING_OTLP_ENDPOINT = "http://localhost:4318/v1/traces"
+DEFAULT_TRACING_SERVICE_NAME = "membrane-backend"
+DEFAULT_TRACING_BATCH_SIZE = 256
+DEFAULT_TRACING_EXPORT_INTERVAL_SECONDS = 5.0
+DEFAULT_TRACING_TRUST_TRACEPARENT = False
+TRACEPARENT_HEADER = "traceparent"
+
+EXPORTERS = ("none", "file", "otlp")
+
+
+class TracingError(Exception):
+    """Raised when tracing is misconfigured."""
+
+
+@dataclass
+class TracingConfig:
+    exporter: str = DEFAULT_TRACING_EXPORTER
+    sample_ratio: float = DEFAULT_TRACING_SAMPLE_RATIO
+    file_path: Path = Path(DEFAULT_TRACING_FILE)
+    otlp_endpoint: str = DEFAULT_TRACING_OTLP_ENDPOINT
+    service_name: str = DEFAULT_TRACING_SERVICE_NAME
+    batch_size: int = DEFAULT_TRACING_BATCH_SIZE
+    export_interval_seconds: float = DEFAULT_TRACING_EXPORT_INTERVAL_SECONDS
+    # Follow the sampled flag of incoming ``traceparent`` headers, rather than
+    # applying ``sample_ratio`` to them too. Only for trusted callers.
+    trust_traceparent: bool = DEFAULT_TRACING_TRUST_TRACEPARENT
+
+
+@dataclass
+class SpanContext:
+    trace_id: str
+    span_id: str
+    sampled: bool
+    # Received from a caller, rather than started in this process.
+    remote: bool = False
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+@dataclass
+class Span:
+    name: str
+    context: SpanContext
+    parent_span_id: str = ""
+    attributes: dict = field(default_factory=dict)
+    events: list = field(default_factory=list)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int = 0
+    error: str = ""
+
+    @property
+    def recording(self):
+        return self.context.sampled
+
+    @property
+    def trace_id(self):
+        return self.context.trace_id
+
+    @property
+    def traceparent(self):
+        return self.context.traceparent
+
+    def set_attribute(self, key, value):
+        if self.recording:
+            self.attributes[key] = value
+
+    def add_event(self, name, **attributes):
+        if self.recording:
+            self.events.append((name, time.time_ns(), attributes))
+
+    def record_exception(self, error):
+        if self.recording:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [
+                {
+                    "name": name,
+                    "timeUnixNano": str(timestamp),
+                    "attributes": _otlp_attributes(attributes),
+                }
+                for name, timestamp, attributes in self.events
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+def _otlp_attributes(attributes):
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            values.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            values.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            values.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            values.append({"key": key, "value": {"stringValue": str(value)}})
+    return values
+
+
+def _new_trace_id():
+    return f"{random.getrandbits(128):032x}"
+
+
+def _new_span_id():
+    return f"{random.getrandbits(64):016x}"
+
+
+def extract(traceparent):
+    """Parse a W3C ``traceparent`` header into a SpanContext, or None if invalid."""
+    if not traceparent:
+        return None
+    parts = traceparent.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return SpanContext(parts[1], parts[2], bool(flags & 1), remote=True)
+
+
+class SpanExporter:
+    """Base class for span exporters. ``export`` receives a batch of spans."""
+
+    def export(self, spans):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class FileSpanExporter(SpanExporter):
+    """Append each batch as one OTLP/JSON line, as the collector file exporter does."""
+
+    def __init__(self, path: Path, service_name: str):
+        self.path = path
+        self.service_name = service_name
+
+    def export(self, spans):
+        line = json.dumps(otlp_payload(spans, self.service_name), separators=(",", ":"))
+        with self.path.open("a") as trace_file:
+            trace_file.write(line + "\n")
+
+
+class OTLPSpanExporter(SpanExporter):
+    """Post batches to an OTLP/HTTP collector using the JSON encoding."""
+
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def export(self, spans):
+        self.session.post(
+            self.endpoint,
+            json=otlp_payload(spans, self.service_name),
+            timeout=self.timeout,
+        ).raise_for_status()
+
+    def shutdown(self):
+        self.session.close()
+
+
+def otlp_payload(spans, service_name):
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _otlp_attributes({"service.name": service_name})
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "membrane"},
+                        "spans": [span.to_otlp() for span in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class BatchSpanProcessor:
+    """Queue finished spans and export them in batches from a daemon thread."""
+
+    def __init__(
+        self,
+        exporter: SpanExporter,
+        batch_size: int = DEFAULT_TRACING_BATCH_SIZE,
+        interval_seconds: float = DEFAULT_TRACING_EXPORT_INTERVAL_SECONDS,
+        max_queue_size: int = 8192,
+    ):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.worker = BatchWorker(
+            self._export,
+            "membrane-span-exporter",
+            batch_size,
+            max_queue_size,
+            interval_seconds + 1,
+        )
+
+    @property
+    def dropped(self) -> int:
+        return self.worker.dropped
+
+    def on_end(self, span: Span):
+        self.worker.submit(span)
+
+    def _export(self, batch):
+        try:
+            self.exporter.export(batch)
+        except Exception as error:
+            logging.warning("Failed to export %d spans: %s", len(batch), error)
+
+    def shutdown(self):
+        self.worker.shutdown()
+        self.exporter.shutdown()
+
+
+_NOOP_SPAN = Span("noop", SpanContext("0" * 32, "0" * 16, False))
+_current_span: ContextVar[Span] = ContextVar("membrane_current_span", default=None)
+
+
+class Tracer:
+    def __init__(self, config: TracingConfig, processor: BatchSpanProcessor = None):
+        self.config = config
+        self.processor = processor
+
+    @property
+    def enabled(self):
+        return self.processor is not None
+
+    def start_span(self, name, parent: SpanContext = None, attributes=None) -> Span:
+        """Start a span and make it current. Finish it with ``end_span``."""
+        if not self.enabled:
+            return _NOOP_SPAN
+        if parent is None:
+            current = _current_span.get()
+            parent = current.context if current is not None else None
+        if parent is None:
+            context = SpanContext(
+                _new_trace_id(),
+                _new_span_id(),
+                random.random() < self.config.sample_ratio,
+            )
+        else:
+            if parent.remote and not self.config.trust_traceparent:
+                # Any caller can set the sampled flag; the trace is continued, but
+                # whether it is recorded is decided here.
+                parent = SpanContext(
+                    parent.trace_id,
+                    parent.span_id,
+                    random.random() < self.config.sample_ratio,
+                )
+            if parent.sampled:
+                context = SpanContext(parent.trace_id, _new_span_id(), True)
+            else:
+                # Unsampled traces keep a single non-recording span for propagation.
+                context = parent
+        span = Span(
+            name,
+            context,
+            parent_span_id=parent.span_id if parent and parent.sampled else "",
+            attributes=dict(attributes or {}) if context.sampled else {},
+        )
+        span._token = _current_span.set(span)
+        return span
+
+    def end_span(self, span: Span, error: Exception = None):
+        if span is _NOOP_SPAN:
+            return
+        try:
+            _current_span.reset(span._token)
+        except ValueError:
+            # Ended from a different context (e.g. a teardown hook).
+            pass
+        if error is not None:
+            span.record_exception(error)
+        if span.recording and not span.end_ns:
+            span.end_ns = time.time_ns()
+            self.processor.on_end(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = self.start_span(name, attributes=attributes)
+        try:
+            yield span
+        except BaseException as error:
+            self.end_span(span, error)
+            raise
+        self.end_span(span)
+
+    def shutdown(self):
+        if self.processor is not None:
+            self.processor.shutdown()
+
+
+_tracer = Tracer(TracingConfig())
+
+
+def configure(config: TracingConfig, exporter: SpanExporter = None) -> Tracer:
+    """Install the process-wide tracer. ``exporter`` overrides ``config.exporter``."""
+    global _tracer
+    if exporter is None:
+        if config.exporter not in EXPORTERS:
+            raise TracingError(
+                f"Unknown tracing exporter {config.exporter}, expected one of "
+                f"{', '.join(EXPORTERS)}."
+            )
+        if config.exporter == "file":
+            exporter = FileSpanExporter(config.file_path, config.service_name)
+        elif config.exporter == "otlp":
+            exporter = OTLPSpanExporter(config.otlp_endpoint, config.service_name)
+    processor = (
+        BatchSpanProcessor(exporter, config.batch_size, config.export_interval_seconds)
+        if exporter is not None
+        else None
+    )
+    _tracer.shutdown()
+    _tracer = Tracer(config, processor)
+    return _tracer
+
+
+def _restart_exporter_after_fork():
+    # The exporter thread does not survive fork(); give the child its own.
+    processor = _tracer.processor
+    if processor is not None:
+        _tracer.processor = BatchSpanProcessor(
+            processor.exporter, processor.batch_size, processor.interval_seconds
+        )
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_exporter_after_fork)
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def current_span() -> Span:
+    return _current_span.get() or _NOOP_SPAN
+
+
+def start_span(name, parent: SpanContext = None, attributes=None) -> Span:
+    return _tracer.start_span(name, parent, attributes)
+
+
+def end_span(span: Span, error: Exception = None):
+    _tracer.end_span(span, error)
+
+
+def span(name, **attributes):
+    return _tracer.span(name, **attributes)
+
+
+def shutdown():
+    _tracer.shutdown()
+
+
+def traced(name=None):
+    """Decorator recording each call of a sync or async function as a span."""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _tracer.span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _tracer.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator